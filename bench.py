@@ -0,0 +1,322 @@
+"""
+Benchmark lambda_handler against local stand-ins for the Drive and Alexa
+Timer APIs (fake_drive.py).
+
+    python bench.py                                  # 10, 100, 1000 and 10000 recipes
+    python bench.py --sizes 100 --latency-ms 80 --iterations 20
+    python bench.py --events recorded_session.jsonl  # replay recorded events verbatim
+    python bench.py --check                          # exit 1 if a budget or check fails
+
+Each iteration replays a navigation session (launch, category tap, recipe
+tap, scrolls, step jump, timers, opening a recipe by title, list paging). The first iteration runs against
+empty caches (cold); the rest reuse them (warm). For every step it reports
+p50/p95/p99 latency, Drive/Timer requests made by the invocation itself,
+and response bytes, plus peak Python memory for one cold session.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import fake_drive
+import lambda_function
+
+# Budgets checked with --check. Responses must stay well under Alexa's
+# response size limit, and warm navigation must not call Drive at all.
+RESPONSE_BYTES_BUDGET = {
+    'launch': 8 * 1024,
+    'category': 12 * 1024,
+    'recipe': 16 * 1024,
+    'open_recipe': 16 * 1024,
+    'set_timer': 1024,
+    'set_all_timers': 2 * 1024,
+    'list_page': 12 * 1024
+}
+# A category list of this many items may only add the shared APL template (or
+# a Link to it) and the response envelope to the bytes of the items themselves
+CATEGORY_CHECK_ITEMS = 200
+CATEGORY_OVERHEAD_BYTES_BUDGET = 1024
+WARM_REQUEST_BUDGET = {'launch': 0, 'category': 0, 'scroll_down': 0, 'scroll_up': 0, 'go_to_step': 0, 'open_recipe': 0, 'list_page': 0}
+
+# Step text and the timers (in seconds) SetAllTimersIntent should read out of it
+TIMER_EXTRACTION_CASES = {
+    'Bake 25 minutes.': [1500],
+    'Simmer for 1 hour and 30 minutes.': [5400],
+    'Rest 20-25 min, then bake an hour.': [1200, 3600],
+    'Chill 1.5 hrs.': [5400],
+    'Simmer for 1/2 hour.': [1800],
+    'Bake 1 1/2 hours.': [5400],
+    'Rise 1½ hours, then ½ hour more.': [5400, 1800],
+    'Add 3/4 cup of milk.': []
+}
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def reset_skill_state(work_dir):
+    """Point the skill at fresh caches (sized from the current limits) and a scratch directory."""
+    lf = lambda_function
+    lf.listing_cache = lf.TTLCache(
+        lf.LISTING_CACHE_MAX_ENTRIES, lf.LISTING_TTL_SECONDS, lf.LISTING_STALE_SECONDS, lf.TENANT_LISTING_MAX_ENTRIES
+    )
+    lf.recipe_layout_cache = lf.TTLCache(
+        lf.RECIPE_LAYOUT_CACHE_MAX_ENTRIES, lf.RECIPE_LAYOUT_TTL_SECONDS, partition_max_entries=lf.TENANT_RECIPE_LAYOUT_MAX_ENTRIES
+    )
+    lf.item_kinds.clear()
+    lf.usage_counts.clear()
+    lf.content_cache = lf.ContentCache(
+        lf.CONTENT_MEMORY_MAX_BYTES,
+        lf.FileContentStore(os.path.join(work_dir, 'content'), lf.CONTENT_DISK_MAX_BYTES, lf.TENANT_CONTENT_DISK_MAX_BYTES),
+        lf.TENANT_CONTENT_MEMORY_MAX_BYTES
+    )
+    lf.SEARCH_INDEX_PATH = os.path.join(work_dir, 'search_index.z')
+    lf._search_indexes.clear()
+    lf._search_index_saved_at.clear()
+    lf._title_indexes.clear()
+    lf.SNAPSHOT_DIRS = ()
+    lf._snapshots.clear()
+    lf._tenant_registry = None
+
+
+def make_event(request, session_attributes, api_endpoint, device_id='bench-device', user_id='bench-user'):
+    return {
+        'session': {'attributes': session_attributes},
+        'context': {'System': {
+            'apiEndpoint': api_endpoint,
+            'apiAccessToken': 'bench-token',
+            'device': {'deviceId': device_id},
+            'user': {'userId': user_id}
+        }},
+        'request': request
+    }
+
+
+def intent(name, **slots):
+    return {'type': 'IntentRequest', 'intent': {'name': name, 'slots': {k: {'value': v} for k, v in slots.items()}}}
+
+
+def navigation_session(rng=None):
+    """
+    Yield (step name, request) pairs for a typical session. The generator is
+    sent each response so later steps can tap what the earlier ones rendered.
+    With rng, the category and recipe are picked at random instead of always
+    the same ones.
+    """
+    response = yield 'launch', {'type': 'LaunchRequest'}
+    categories = response['response']['directives'][0]['datasources']['categoryList']['items']
+    category = rng.choice(categories) if rng else categories[len(categories) // 2]
+
+    response = yield 'category', {'type': 'Alexa.Presentation.APL.UserEvent', 'arguments': [category['id'], 'folder', category['name']]}
+    recipe_list = response['response']['directives'][0]['datasources']['recipeList']
+    recipe = rng.choice(recipe_list['items']) if rng else recipe_list['items'][0]
+
+    yield 'recipe', {'type': 'Alexa.Presentation.APL.UserEvent', 'arguments': [recipe['id'], 'recipe', recipe['name']]}
+    yield 'scroll_down', intent('ScrollDownIntent')
+    yield 'scroll_down', intent('ScrollDownIntent')
+    yield 'go_to_step', intent('GoToStepIntent', number='2')
+    yield 'set_timer', intent('SetTimerIntent', duration='PT10M')
+    yield 'set_all_timers', intent('SetAllTimersIntent')
+    yield 'scroll_up', intent('ScrollUpIntent')
+    yield 'open_recipe', intent('OpenRecipeIntent', title=recipe['name'])
+    if recipe_list['maximumExclusiveIndex'] > len(recipe_list['items']):
+        yield 'list_page', {
+            'type': 'Alexa.Presentation.APL.LoadIndexListData',
+            'token': lambda_function.RECIPE_LIST_TOKEN,
+            'correlationToken': 'bench',
+            'listId': recipe_list['listId'],
+            'startIndex': len(recipe_list['items']),
+            'count': lambda_function.RECIPE_LIST_WINDOW
+        }
+
+
+def recorded_session(path):
+    """Replay requests from a JSON-lines file of recorded Alexa events."""
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                event = json.loads(line)
+                request = event['request']
+                yield request.get('intent', {}).get('name') or request['type'], request
+
+
+def run_session(session, api_endpoint, samples):
+    """Drive one session through lambda_handler, appending per-step samples."""
+    session_attributes = {}
+    response = None
+    try:
+        step, request = next(session)
+        while True:
+            event = make_event(request, session_attributes, api_endpoint)
+            started = time.perf_counter()
+            response = lambda_function.lambda_handler(event, None)
+            elapsed = time.perf_counter() - started
+            samples.append({
+                'step': step,
+                'ms': elapsed * 1000,
+                'requests': lambda_function.last_invocation_metrics.get('http_requests', 0),
+                'bytes': len(json.dumps(response))
+            })
+            session_attributes = response.get('sessionAttributes', session_attributes)
+            step, request = session.send(response)
+    except StopIteration:
+        pass
+
+
+def summarize(samples):
+    rows = {}
+    for sample in samples:
+        rows.setdefault(sample['step'], []).append(sample)
+    summary = {}
+    for step, step_samples in rows.items():
+        latencies = [s['ms'] for s in step_samples]
+        summary[step] = {
+            'n': len(step_samples),
+            'p50_ms': percentile(latencies, 0.50),
+            'p95_ms': percentile(latencies, 0.95),
+            'p99_ms': percentile(latencies, 0.99),
+            'requests': statistics.mean(s['requests'] for s in step_samples),
+            'max_requests': max(s['requests'] for s in step_samples),
+            'max_bytes': max(s['bytes'] for s in step_samples)
+        }
+    return summary
+
+
+def print_summary(title, summary):
+    print(f'  {title}')
+    print(f"    {'step':<16}{'n':>5}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'reqs':>7}{'bytes':>9}")
+    for step, row in summary.items():
+        print(f"    {step:<16}{row['n']:>5}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}{row['p99_ms']:>10.2f}"
+              f"{row['requests']:>7.1f}{row['max_bytes']:>9}")
+
+
+def check_timer_extraction():
+    failures = []
+    for text, expected in TIMER_EXTRACTION_CASES.items():
+        found = lambda_function.extract_step_durations(text)
+        if found != expected:
+            failures.append(f'timers in {text!r}: got {found}, expected {expected}')
+    return failures
+
+
+def check_category_payload():
+    """Check that a large category list is sent as datasource items bound to the shared template."""
+    lf = lambda_function
+    folders = [{'id': f'folder{i:06d}', 'name': f'Category {i}'} for i in range(CATEGORY_CHECK_ITEMS)]
+    budget = len(json.dumps(folders)) + CATEGORY_OVERHEAD_BYTES_BUDGET
+    work_dir = tempfile.mkdtemp(prefix='recipe-bench-')
+    links = lf.APL_DOCUMENT_LINKS
+    failures = []
+    try:
+        reset_skill_state(work_dir)
+        lf.listing_cache.set(lf.tenant_key('subfolders', lf.current_tenant()['rootFolderId']), folders)
+        for mode in ('inline', 'linked'):
+            lf.APL_DOCUMENT_LINKS = mode == 'linked'
+            response = lf.display_categories()
+            directive = response['response']['directives'][0]
+            document = directive['document']
+            size = len(json.dumps(response))
+            if size > budget:
+                failures.append(f'{mode} category list of {CATEGORY_CHECK_ITEMS} items is {size} bytes (budget {budget})')
+            if document is not lf.APL_DOCUMENTS['categoryList'] and document.get('type') != 'Link':
+                failures.append(f'{mode} category list is not sent with the shared categoryList template')
+            if len(directive['datasources']['categoryList']['items']) != CATEGORY_CHECK_ITEMS:
+                failures.append(f'{mode} category list datasource does not hold all {CATEGORY_CHECK_ITEMS} items')
+    finally:
+        lf.APL_DOCUMENT_LINKS = links
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return failures
+
+
+def check_budgets(size, cold, warm):
+    failures = []
+    for step, row in {**cold, **warm}.items():
+        budget = RESPONSE_BYTES_BUDGET.get(step)
+        if budget and row['max_bytes'] > budget:
+            failures.append(f'{size} recipes: {step} response is {row["max_bytes"]} bytes (budget {budget})')
+    for step, row in warm.items():
+        budget = WARM_REQUEST_BUDGET.get(step)
+        if budget is not None and row['max_requests'] > budget:
+            failures.append(f'{size} recipes: warm {step} made {row["max_requests"]} requests (budget {budget})')
+    return failures
+
+
+def benchmark_size(size, args):
+    drive = fake_drive.FakeDrive(fake_drive.synthetic_tree(size), latency=args.latency_ms / 1000)
+    server = fake_drive.serve(drive)
+    base_url = f'http://127.0.0.1:{server.server_port}'
+    lambda_function.DRIVE_API_BASE = base_url
+    lambda_function.API_KEY = 'bench-key'
+    lambda_function.ROOT_FOLDER_ID = 'root'
+    work_dir = tempfile.mkdtemp(prefix='recipe-bench-')
+
+    def session():
+        return recorded_session(args.events) if args.events else navigation_session()
+
+    try:
+        # Peak memory for one cold session, measured separately because tracing is slow
+        reset_skill_state(work_dir)
+        tracemalloc.start()
+        run_session(session(), base_url, [])
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        cold_samples, warm_samples = [], []
+        for iteration in range(args.iterations):
+            if iteration == 0:
+                shutil.rmtree(work_dir, ignore_errors=True)
+                reset_skill_state(work_dir)
+            run_session(session(), base_url, cold_samples if iteration == 0 else warm_samples)
+    finally:
+        server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    cold, warm = summarize(cold_samples), summarize(warm_samples)
+    print(f'{size} recipes, {args.latency_ms:g} ms API latency, peak memory {peak_bytes / 1024 / 1024:.1f} MiB')
+    print_summary('cold', cold)
+    if warm:
+        print_summary('warm', warm)
+    return {'size': size, 'peak_bytes': peak_bytes, 'cold': cold, 'warm': warm}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10,100,1000,10000', help='Comma-separated recipe counts')
+    parser.add_argument('--latency-ms', type=float, default=20, help='Latency added to every fake API response')
+    parser.add_argument('--iterations', type=int, default=10, help='Sessions per size; the first one is cold')
+    parser.add_argument('--events', help='JSON-lines file of recorded Alexa events to replay instead')
+    parser.add_argument('--prefetch', action='store_true', help='Leave background prefetching on')
+    parser.add_argument('--json', help='Also write the results to this file')
+    parser.add_argument('--check', action='store_true', help='Exit 1 if a response size or request budget is exceeded or a check fails')
+    args = parser.parse_args()
+
+    lambda_function.logger.setLevel('WARNING')
+    lambda_function.METRICS_ENABLED = False
+    lambda_function.PREFETCH_ENABLED = args.prefetch
+
+    results = [benchmark_size(int(size), args) for size in args.sizes.split(',')]
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    if args.check:
+        failures = [f for r in results for f in check_budgets(r['size'], r['cold'], r['warm'])]
+        failures += check_timer_extraction()
+        failures += check_category_payload()
+        for failure in failures:
+            print(f'FAIL {failure}')
+        if failures:
+            sys.exit(1)
+        print('All budgets and checks met')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Walk the Drive recipe tree once and write a snapshot the skill can serve
+navigation from on a cold start.
+
+    python build_snapshot.py --api-key KEY --root FOLDER_ID
+    python build_snapshot.py --api-key KEY --root FOLDER_ID --include-content -o /tmp/recipe_snapshot-FOLDER_ID.json.gz
+
+The output is named after the root folder (recipe_snapshot-FOLDER_ID.json.gz),
+so snapshots for several households can sit side by side. With
+--include-content a search index of the recipe text is written next to it
+(recipe_search_index-FOLDER_ID.z), so a cold start doesn't have to rebuild
+it; it is only read by the Python version that wrote it, so build with the
+Lambda runtime's version. Bundle both next to lambda_function.py (or copy
+them to /tmp) and the skill will pick them up. Set DRIVE_API_BASE to build
+from fake_drive.py instead of Google.
+"""
+import argparse
+import datetime
+import logging
+import os
+import time
+
+import lambda_function
+from lambda_function import FOLDER_MIME_TYPE, SNAPSHOT_FORMAT_VERSION, SNAPSHOT_INDEX_FILENAME, snapshot_filename
+from recipe_search import SearchIndex
+
+logger = logging.getLogger()
+
+# Only Google Docs can be exported as text; other files in the tree are listed but not exported
+DOCUMENT_MIME_TYPE = 'application/vnd.google-apps.document'
+
+
+def walk_tree(root_id):
+    """
+    Yield [id, parent_id, name, mimeType, modifiedTime] for every file under
+    root_id. Each level of folders is listed with batched queries.
+    """
+    level = [root_id]
+    while level:
+        next_level = []
+        for parent_id, file in lambda_function.iter_children(level):
+            if file['mimeType'] == FOLDER_MIME_TYPE:
+                next_level.append(file['id'])
+            yield [file['id'], parent_id, file['name'], file['mimeType'], file['modifiedTime']]
+        level = next_level
+
+
+def build_snapshot(root_id, include_content=False):
+    items = list(walk_tree(root_id))
+    snapshot = {
+        'version': SNAPSHOT_FORMAT_VERSION,
+        'rootId': root_id,
+        'createdAt': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'items': items
+    }
+    if include_content:
+        # Content is keyed by id and stored with the modifiedTime it was exported at.
+        # A document that fails to export is left out; the skill fetches it from Drive.
+        content = snapshot['content'] = {}
+        for file_id, _, name, mime_type, modified_time in items:
+            if mime_type != DOCUMENT_MIME_TYPE:
+                continue
+            try:
+                content[file_id] = [modified_time, lambda_function.export_document_text(file_id)]
+            except Exception as e:
+                logger.warning(f"Skipping content of {name} ({file_id}): {e}")
+    return snapshot
+
+
+def build_search_index(snapshot):
+    """Index the snapshot's recipe text the way the skill would."""
+    index = SearchIndex()
+    names = {item[0]: item[2] for item in snapshot['items']}
+    for file_id, (modified_time, text) in snapshot['content'].items():
+        index.update(file_id, names.get(file_id), modified_time, text)
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--api-key', default=lambda_function.API_KEY)
+    parser.add_argument('--root', default=lambda_function.ROOT_FOLDER_ID, help='Root recipe folder ID')
+    parser.add_argument('-o', '--output', help='Output file (defaults to recipe_snapshot-ROOT.json.gz)')
+    parser.add_argument('--include-content', action='store_true', help='Also store the cleaned text of every recipe')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    lambda_function.API_KEY = args.api_key
+
+    started = time.perf_counter()
+    snapshot = build_snapshot(args.root, args.include_content)
+    args.output = args.output or snapshot_filename(args.root)
+    lambda_function.write_snapshot(snapshot, args.output)
+    summary = f"Wrote {len(snapshot['items'])} items"
+    if args.include_content:
+        summary += f" and the text of {len(snapshot['content'])} documents"
+    print(f"{summary} to {args.output} in {time.perf_counter() - started:.1f}s")
+    if args.include_content:
+        index_path = os.path.join(os.path.dirname(args.output), snapshot_filename(args.root, SNAPSHOT_INDEX_FILENAME))
+        build_search_index(snapshot).save(index_path)
+        print(f"Wrote the search index to {index_path}")
+
+
+if __name__ == '__main__':
+    main()
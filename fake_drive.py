@@ -0,0 +1,267 @@
+"""
+Local stand-in for the parts of the Google Drive v3 API the skill uses
+(files.list with paging, files.get and files.export as text/plain) and for
+the Alexa Timer API (POST /v1/alerts/timers), with configurable latency.
+
+    python fake_drive.py --tree tree.json --port 8080
+    python fake_drive.py --synthetic 1000 --latency-ms 50
+    DRIVE_API_BASE=http://127.0.0.1:8080 python build_snapshot.py --root root ...
+
+A tree file is nested JSON: {"name": ..., "children": [...]} for folders and
+{"name": ..., "content": ...} for recipe documents. Ids are generated when
+missing, and the top-level folder's id defaults to "root".
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+DOCUMENT_MIME_TYPE = 'application/vnd.google-apps.document'
+DEFAULT_MODIFIED_TIME = '2024-12-01T12:00:00.000Z'
+MAX_PAGE_SIZE = 1000
+
+SAMPLE_TREE = {
+    'id': 'root',
+    'name': 'Recipes',
+    'children': [
+        {'name': 'Breakfast', 'children': [
+            {'name': 'Buttermilk Pancakes', 'content': 'Ingredients\n2 cups flour\n2 cups buttermilk\n2 eggs\n\nSteps\n1. Whisk everything together.\n2. Cook on a hot griddle for 3 minutes per side.'},
+            {'name': 'Overnight Oats', 'content': 'Ingredients\n1 cup oats\n1 cup milk\n\nSteps\n1. Mix and refrigerate for 8 hours.'}
+        ]},
+        {'name': 'Desserts', 'children': [
+            {'name': 'Chocolate Chip Cookies', 'content': 'Ingredients\n1 cup butter\n2 cups chocolate chips\n\nSteps\n1. Cream the butter and sugar.\n2. Bake 12 minutes at 375F.'}
+        ]}
+    ]
+}
+
+INGREDIENTS = (
+    'flour', 'sugar', 'butter', 'eggs', 'milk', 'buttermilk', 'salt', 'baking soda', 'vanilla',
+    'chocolate chips', 'oats', 'chicken', 'onion', 'garlic', 'tomatoes', 'basil', 'cream', 'cheese'
+)
+DISHES = ('Cake', 'Cookies', 'Pancakes', 'Soup', 'Casserole', 'Bread', 'Pie', 'Salad', 'Muffins', 'Stew')
+ADJECTIVES = ('Grandma\'s', 'Easy', 'Classic', 'Spicy', 'Lemon', 'Chocolate', 'Garlic', 'Maple', 'Holiday', 'Quick')
+
+
+def synthetic_recipe(rng):
+    ingredients = rng.sample(INGREDIENTS, rng.randint(4, 9))
+    lines = ['Ingredients'] + [f'{rng.randint(1, 4)} cups {ingredient}' for ingredient in ingredients]
+    lines += ['', 'Directions']
+    for number in range(1, rng.randint(4, 10)):
+        lines.append(f'{number}. {rng.choice(("Mix", "Whisk", "Fold", "Stir"))} in the {rng.choice(ingredients)} '
+                     f'and {rng.choice(("bake", "simmer", "rest", "chill"))} for {rng.randint(2, 45)} minutes.')
+    lines += ['', 'Notes', 'Keeps for three days in the fridge.']
+    return '\n'.join(lines)
+
+
+def synthetic_tree(recipe_count, category_count=None, seed=0, id_prefix=''):
+    """
+    Build a root -> categories -> recipes tree with recipe_count recipes.
+    Ids start with id_prefix, so several trees can be served side by side.
+    """
+    rng = random.Random(seed)
+    category_count = category_count or min(50, max(2, recipe_count // 20))
+    categories = [{'id': f'{id_prefix}cat{i:04d}', 'name': f'Category {i:04d}', 'children': []} for i in range(category_count)]
+    for i in range(recipe_count):
+        name = f'{rng.choice(ADJECTIVES)} {rng.choice(DISHES)} {i}'
+        categories[i % category_count]['children'].append({'id': f'{id_prefix}doc{i:06d}', 'name': name, 'content': synthetic_recipe(rng)})
+    return {'id': f'{id_prefix}root', 'name': 'Recipes', 'children': categories}
+
+
+CLAUSE_PATTERN = re.compile(
+    r"\s*(?:'(?P<parent>[^']*)' in parents"
+    r"|mimeType\s*(?P<op>!=|=)\s*'(?P<mime>[^']*)'"
+    r"|trashed\s*=\s*(?P<trashed>true|false))\s*"
+)
+
+
+class FakeDrive:
+    """In-memory file tree answering Drive-shaped queries."""
+
+    def __init__(self, tree=None, latency=0.0):
+        self.files = {}
+        self.latency = latency
+        self.request_count = 0
+        self.timers = []
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._results = {}
+        self.add_tree(tree or SAMPLE_TREE)
+
+    def add_tree(self, node, parent=None):
+        self._results.clear()
+        file_id = node.get('id') or self._new_id()
+        is_folder = 'children' in node or 'content' not in node
+        self.files[file_id] = {
+            'id': file_id,
+            'name': node['name'],
+            'mimeType': FOLDER_MIME_TYPE if is_folder else DOCUMENT_MIME_TYPE,
+            'modifiedTime': node.get('modifiedTime', DEFAULT_MODIFIED_TIME),
+            'parents': [parent] if parent else [],
+            'trashed': node.get('trashed', False),
+            'content': node.get('content', '')
+        }
+        for child in node.get('children', []):
+            self.add_tree(child, file_id)
+        return file_id
+
+    def _new_id(self):
+        self._next_id += 1
+        return f'fake{self._next_id:06d}'
+
+    @staticmethod
+    def parse_query(query):
+        """
+        Parse a query made of and-ed clauses, where a clause may also be a
+        parenthesized group of or-ed clauses, into a list of or-groups.
+        """
+        groups = []
+        for clause in query.split(' and '):
+            clause = clause.strip()
+            parts = clause[1:-1].split(' or ') if clause.startswith('(') and clause.endswith(')') else [clause]
+            group = []
+            for part in parts:
+                match = CLAUSE_PATTERN.fullmatch(part)
+                if not match:
+                    raise ValueError(f'Unsupported query clause: {part}')
+                group.append(match)
+            groups.append(group)
+        return groups
+
+    @staticmethod
+    def matches_clause(file, match):
+        if match['parent'] is not None:
+            return match['parent'] in file['parents']
+        if match['mime'] is not None:
+            return (file['mimeType'] == match['mime']) == (match['op'] == '=')
+        return file['trashed'] == (match['trashed'] == 'true')
+
+    def matches(self, file, query):
+        groups = self.parse_query(query) if isinstance(query, str) else query
+        return all(any(self.matches_clause(file, match) for match in group) for group in groups)
+
+    def list_files(self, query, page_size, page_token):
+        # Paging through a large listing re-runs the same query, so keep its result
+        matching = self._results.get(query)
+        if matching is None:
+            groups = self.parse_query(query)
+            matching = self._results[query] = sorted(
+                (file for file in self.files.values() if self.matches(file, groups)),
+                key=lambda file: file['name'].lower()
+            )
+        start = int(page_token or 0)
+        end = start + min(page_size, MAX_PAGE_SIZE)
+        response = {'files': [self.public_fields(file) for file in matching[start:end]]}
+        if end < len(matching):
+            response['nextPageToken'] = str(end)
+        return response
+
+    @staticmethod
+    def public_fields(file):
+        return {key: file[key] for key in ('id', 'name', 'mimeType', 'modifiedTime', 'parents')}
+
+
+class FakeDriveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real API
+    disable_nagle_algorithm = True  # headers and body go out in separate writes
+    drive = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload):
+        self.send_body(status, json.dumps(payload).encode('utf-8'), 'application/json')
+
+    def send_body(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def count_request(self):
+        with self.drive._lock:
+            self.drive.request_count += 1
+        if self.drive.latency:
+            time.sleep(self.drive.latency)
+
+    def do_POST(self):
+        self.count_request()
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path != '/v1/alerts/timers':
+            return self.send_json(404, {'message': 'Not found'})
+        if not self.headers.get('Authorization', '').startswith('Bearer '):
+            return self.send_json(401, {'message': 'Missing access token'})
+        timer = json.loads(body)
+        with self.drive._lock:
+            timer_id = f'timer{len(self.drive.timers) + 1}'
+            self.drive.timers.append(timer)
+        self.send_json(200, {'id': timer_id, 'status': 'ON', 'duration': timer.get('duration')})
+
+    def do_GET(self):
+        self.count_request()
+        parts = urllib.parse.urlsplit(self.path)
+        params = {key: values[0] for key, values in urllib.parse.parse_qs(parts.query).items()}
+        path = parts.path.split('/')
+
+        if parts.path == '/drive/v3/files':
+            try:
+                listing = self.drive.list_files(
+                    params.get('q', ''),
+                    int(params.get('pageSize', 100)),
+                    params.get('pageToken')
+                )
+            except ValueError as e:
+                return self.send_json(400, {'error': {'code': 400, 'message': str(e)}})
+            return self.send_json(200, listing)
+
+        if len(path) >= 5 and path[1:4] == ['drive', 'v3', 'files']:
+            file = self.drive.files.get(path[4])
+            if file is None:
+                return self.send_json(404, {'error': {'code': 404, 'message': 'File not found'}})
+            if len(path) == 6 and path[5] == 'export':
+                return self.send_body(200, file['content'].encode('utf-8'), 'text/plain; charset=utf-8')
+            if len(path) == 5:
+                return self.send_json(200, FakeDrive.public_fields(file))
+
+        self.send_json(404, {'error': {'code': 404, 'message': 'Not found'}})
+
+
+def serve(drive, host='127.0.0.1', port=0):
+    """Start a server for drive on a background thread and return it."""
+    handler = type('BoundFakeDriveHandler', (FakeDriveHandler,), {'drive': drive})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tree', help='JSON tree file (defaults to a small sample tree)')
+    parser.add_argument('--synthetic', type=int, metavar='RECIPES', help='Serve a generated tree with this many recipes')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Delay added to every response')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+
+    tree = None
+    if args.tree:
+        with open(args.tree, encoding='utf-8') as f:
+            tree = json.load(f)
+    elif args.synthetic:
+        tree = synthetic_tree(args.synthetic)
+    server = serve(FakeDrive(tree, args.latency_ms / 1000), args.host, args.port)
+    print(f'Fake Drive API listening on http://{args.host}:{server.server_port}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
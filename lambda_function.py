@@ -1,141 +1,1357 @@
+import time
+
+# Module import is the start of Lambda's init phase; init() at the bottom of
+# this file reports how long it took.
+_init_started = time.perf_counter()
+
+import base64
+import contextvars
+import gzip
+import http.client
 import json
+import os
+import random
 import urllib.parse
-import urllib.request
 import logging
-import datetime
 import re
+import sys
+import threading
+import zlib
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+# sqlite3 (RECIPE_STORE=sqlite), concurrent.futures (prefetch) and
+# recipe_search (SearchRecipeIntent) are imported where they are first used,
+# so cold starts that never take those paths don't pay for them.
 
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
 
 API_KEY = "GET A GOOGLE DRIVE API KEY AND PASTE IT HERE"  # Replace with your Google API Key
 ROOT_FOLDER_ID = "GET THE ROOT FOLDER ID OF YOUR GOOGLE DRIVE FOLDER WITH YOUR RECIPES"
 
-# Global variable to store the last viewed recipe content
-last_viewed_recipe = {"content": None}
+# Point this at a local stand-in (see fake_drive.py) for testing
+DRIVE_API_BASE = os.environ.get('DRIVE_API_BASE', 'https://www.googleapis.com')
 
-# === Helper Functions ===
+# Multi-household mode: TENANTS_FILE is a JSON file giving each household its
+# own root folder (and optionally its own API key), matched by the Alexa
+# device or user id of each request:
+#   {"tenants": {"smiths": {"rootFolderId": "...", "apiKey": "...",
+#                           "devices": ["amzn1.ask.device..."], "users": ["amzn1.ask.account..."]}},
+#    "default": "smiths"}
+# Requests from devices and users that aren't listed go to the "default"
+# tenant if there is one and are turned away otherwise. Without a TENANTS_FILE
+# every request uses API_KEY and ROOT_FOLDER_ID.
+TENANTS_FILE = os.environ.get('TENANTS_FILE')
+DEFAULT_TENANT_ID = 'default'
 
-def clean_recipe_content(content):
-    """Remove unnecessary characters and ensure correct line breaks."""
-    content = content.replace('\u00a0', ' ').strip()  # Remove non-breaking spaces
-    content = content.replace('\r\n', '\n').replace('\r', '\n')  # Normalize line breaks
-    content = ''.join(filter(lambda x: x.isprintable() or x in '\n', content))  # Clean hidden characters
-    return content
+# Full request/response payloads are only logged at DEBUG level or for this
+# fraction of invocations. Every invocation emits one metrics line in
+# CloudWatch Embedded Metric Format with per-stage timings and cache hit ratios.
+DEBUG_SAMPLE_RATE = float(os.environ.get('DEBUG_SAMPLE_RATE', '0'))
+METRICS_NAMESPACE = 'RecipeViewer'
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
 
-def fetch_subfolders():
-    """Fetch subfolder (category) details from the root folder."""
-    query_params = {
-        'q': f"'{ROOT_FOLDER_ID}' in parents and mimeType='application/vnd.google-apps.folder'",
-        'key': API_KEY,
-        'fields': 'files(id, name)'
-    }
-    query_string = urllib.parse.urlencode(query_params)
-    query_url = f'https://www.googleapis.com/drive/v3/files?{query_string}'
+# Shared HTTP client: keep-alive connections are pooled per host across warm
+# invocations, and transient 429/5xx responses are retried with jittered backoff.
+HTTP_TIMEOUT_SECONDS = 5
+HTTP_MAX_RETRIES = 2
+HTTP_BACKOFF_SECONDS = 0.2
+HTTP_MAX_RETRY_AFTER_SECONDS = 2
+HTTP_IDLE_CONNECTIONS_PER_HOST = 4
+HTTP_RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Requests that aren't safe to repeat (timer POSTs) are only retried when the
+# server can't have acted on them: a rate limit or unavailable response, or a
+# pooled connection that turned out to be closed before the request was read.
+# A timeout or a 500/502/504 may mean the timer was already created.
+HTTP_UNSAFE_RETRY_STATUSES = {429, 503}
+HTTP_STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, BrokenPipeError)
+# Google APIs only gzip responses for clients that say so in the User-Agent
+HTTP_USER_AGENT = 'Alexa-Google-Doc-Viewer (gzip)'
+
+# Alexa gives up on a response after 8 seconds. Each invocation gets a
+# deadline RESPONSE_DEADLINE_SECONDS out (or sooner, if the Lambda has less
+# time left), and every HTTP attempt's timeout is cut to what remains of it
+# minus RESPONSE_RESERVE_SECONDS for building the response. When Drive can't
+# answer in time, the last cached listing or recipe is served, marked stale,
+# and fetched again in the background.
+RESPONSE_DEADLINE_SECONDS = 7
+RESPONSE_RESERVE_SECONDS = 0.5
+
+# Drive listings are kept in a module-level cache so warm Lambda invocations
+# can skip the files.list round trip. After the TTL an entry is still served
+# (stale) while a background refresh fetches the new listing.
+LISTING_TTL_SECONDS = 300
+LISTING_STALE_SECONDS = 24 * 3600
+
+# Every cache is split into one partition per tenant. A partition never grows
+# past its tenant's quota, and once the container-wide limit is reached the
+# largest partition gives up its least recently used entries first, so one
+# household with a huge library can't push everyone else's recipes out.
+LISTING_CACHE_MAX_ENTRIES = 1024
+TENANT_LISTING_MAX_ENTRIES = 256
+
+# Cleaned recipe text is cached in memory (bounded by size) and on disk under
+# /tmp, keyed by file id and Drive modifiedTime. The modifiedTime is re-checked
+# with a cheap files.get at most once per CONTENT_REVALIDATE_SECONDS.
+CONTENT_MEMORY_MAX_BYTES = 16 * 1024 * 1024
+TENANT_CONTENT_MEMORY_MAX_BYTES = 8 * 1024 * 1024
+CONTENT_DISK_MAX_BYTES = 128 * 1024 * 1024
+TENANT_CONTENT_DISK_MAX_BYTES = 64 * 1024 * 1024
+CONTENT_CACHE_DIR = '/tmp/recipe_cache'
+CONTENT_REVALIDATE_SECONDS = 60
+
+# Persistent tier behind the in-memory content cache: 'file' (JSON files under
+# CONTENT_CACHE_DIR), 'sqlite' (a local stand-in for a shared key-value store)
+# or 'session' (no server-side persistence; the text travels compressed in the
+# session attributes instead).
+RECIPE_STORE = os.environ.get('RECIPE_STORE', 'file')
+RECIPE_STORE_SQLITE_PATH = '/tmp/recipes.db'
+SESSION_COMPRESS_MIN_BYTES = 1024
+
+# After a recipe list is rendered, the recipes most likely to be tapped next
+# (ranked by how often they were opened in this container) are fetched on a
+# small thread pool so the next tap is a cache hit. Category listings need no
+# prefetch: the whole tree is listed with the category list (see load_tree).
+# Each batch has a hard time and request budget, and submitting it never
+# blocks the response.
+PREFETCH_ENABLED = os.environ.get('PREFETCH_ENABLED', '1') == '1'
+PREFETCH_TOP_N = 3
+PREFETCH_WORKERS = 2
+PREFETCH_MAX_REQUESTS = 6
+PREFETCH_BUDGET_SECONDS = 2.0
+
+# Full-text search index over cleaned recipe text. It is updated whenever a
+# recipe's content passes through fetch_recipe_content() and written to /tmp
+# at most once per SEARCH_INDEX_SAVE_INTERVAL_SECONDS. A cold container starts
+# from the newer of that file and the index build_snapshot.py bundles with a
+# snapshot (SNAPSHOT_INDEX_FILENAME).
+SEARCH_INDEX_PATH = '/tmp/search_index.z'
+SEARCH_INDEX_SAVE_INTERVAL_SECONDS = 30
+SEARCH_RESULT_LIMIT = 20
+# Recipes listed but not yet indexed when someone searches are read on the
+# prefetch pool, at most SEARCH_CRAWL_MAX_RECIPES per search and within
+# SEARCH_CRAWL_BUDGET_SECONDS, and the answer says how much was searched.
+SEARCH_CRAWL_MAX_RECIPES = 10
+SEARCH_CRAWL_BUDGET_SECONDS = 5.0
 
-    logger.info("Fetching subfolders with URL: %s", query_url)
+# OpenRecipeIntent resolves a spoken title against an index of every recipe
+# name seen in a listing, updated folder by folder as listings are fetched.
+# A match below TITLE_MATCH_MIN_SCORE is rejected, and when the runner-up
+# scores within TITLE_MATCH_MARGIN of the best the candidates are listed. So
+# are all titles with every spoken word in them, when there are several and
+# none is exactly what was said ("open cookies").
+TITLE_MATCH_MIN_SCORE = 0.5
+TITLE_MATCH_MARGIN = 0.05
+
+# An offline snapshot of the folder tree (written by build_snapshot.py) lets a
+# cold container serve navigation without waiting on Drive. Its listings are
+# loaded into the listing cache as stale entries, so they are shown at once and
+# refreshed from Drive in the background. Recipe text in it goes into the
+# content cache (within the tenant's share of memory, then its store) and the
+# search index, and isn't kept otherwise. Each root folder's snapshot is named
+# after it (see snapshot_filename), so a tenant only reads its own; the default
+# tenant also reads an unnamed SNAPSHOT_FILENAME. The newest matching file wins.
+SNAPSHOT_FORMAT_VERSION = 1
+SNAPSHOT_FILENAME = 'recipe_snapshot.json.gz'
+SNAPSHOT_INDEX_FILENAME = 'recipe_search_index.z'
+SNAPSHOT_DIRS = (os.path.dirname(os.path.abspath(__file__)), '/tmp')
+
+# Scroll intents move the recipe view by this fraction of the screen
+SCROLL_FRACTION = 0.75
+
+# Recipes are shown as a Sequence of short rows. The row layout (and where
+# each section and step starts) is parsed once per document version.
+RECIPE_COMPONENT_ID = 'recipeSequence'
+RECIPE_LAYOUT_CACHE_MAX_ENTRIES = 256
+TENANT_RECIPE_LAYOUT_MAX_ENTRIES = 64
+RECIPE_LAYOUT_TTL_SECONDS = 24 * 3600
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+# files.list returns at most 1000 files per page; anything beyond that is
+# reached through nextPageToken.
+DRIVE_PAGE_SIZE = 1000
+
+# The categories and the recipes in all of them are listed together: folder
+# ids are OR-ed into one files.list query ("'a' in parents or 'b' in parents")
+# of up to this many characters, which keeps the URL well under Google's
+# limit. 50 categories fit in one query, so a full refresh is 2 round trips.
+DRIVE_QUERY_MAX_LENGTH = 4000
+TREE_FIELDS = 'id, name, mimeType, parents, modifiedTime'
+
+# Recipe lists are sent to the device as an APL dynamicIndexList. Only the
+# first window is included in the RenderDocument; the device asks for the rest
+# with LoadIndexListData requests as the user scrolls.
+RECIPE_LIST_TOKEN = 'recipeListToken'
+RECIPE_LIST_WINDOW = 50
+
+# Timers are confirmed by voice and leave the document on screen alone.
+# SetAllTimersIntent reads durations ("bake 25 minutes") out of the recipe's
+# steps and creates up to TIMER_BATCH_MAX timers in parallel; timers the API
+# hasn't confirmed by TIMER_BATCH_DEADLINE_SECONDS are reported as pending.
+TIMER_API_TIMEOUT_SECONDS = 3
+TIMER_BATCH_MAX = 5
+TIMER_BATCH_DEADLINE_SECONDS = 2.5
+TIMER_MAX_SECONDS = 24 * 3600
+
+# Once per container, during Lambda's init phase, init() loads the snapshot
+# and opens a keep-alive connection to Drive so the first request doesn't wait
+# for DNS and TLS. Preconnecting is only on by default inside Lambda. The init
+# duration is reported with the first invocation's metrics.
+INIT_PRECONNECT = os.environ.get('INIT_PRECONNECT', '1' if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ else '0') == '1'
+INIT_PRECONNECT_TIMEOUT_SECONDS = 1
+
+# Item kinds ('folder' or 'recipe') by Drive id, filled from earlier listings so
+# a touch selection can be dispatched without asking Drive for its mimeType.
+item_kinds = {}
+
+# === Instrumentation ===
+
+# Values reported for the most recent invocation, for benchmarks and tests
+last_invocation_metrics = {}
+
+# Set by init() and reported once, with the container's first invocation
+_pending_init_metrics = None
+
+# Metrics for the invocation running in the current context. Prefetch and
+# background refresh threads start with an empty context, so their work is not
+# charged to the request that scheduled it.
+_invocation_metrics = contextvars.ContextVar('invocation_metrics', default=None)
+
+def start_invocation(request_type):
+    metrics = {
+        'request_type': request_type,
+        'sampled': random.random() < DEBUG_SAMPLE_RATE,
+        'started': time.perf_counter(),
+        'stages': Counter(),
+        'counts': Counter()
+    }
+    _invocation_metrics.set(metrics)
+    return metrics
 
+@contextmanager
+def stage(name):
+    """Add the time spent in the block to the named stage of the current invocation."""
+    metrics = _invocation_metrics.get()
+    if metrics is None:
+        yield
+        return
+    started = time.perf_counter()
     try:
-        with urllib.request.urlopen(query_url) as response:
-            data = json.loads(response.read().decode())
-        logger.info("Raw Subfolders API Response: %s", json.dumps(data, indent=2))
+        yield
+    finally:
+        metrics['stages'][name] += time.perf_counter() - started
 
-        # Create a dictionary with folder names and IDs
-        folder_names = {folder['name']: folder['id'] for folder in data.get('files', [])}
-        
-        # Sort the folder names alphabetically
-        sorted_folder_names = sorted(folder_names.keys())
+def count(name, amount=1):
+    metrics = _invocation_metrics.get()
+    if metrics is not None:
+        metrics['counts'][name] += amount
 
-        return sorted_folder_names, folder_names
-    except Exception as e:
-        logger.error("Error fetching subfolders: %s", e)
-        return [], {}
+def log_payload(message, build_payload):
+    """
+    Log a JSON payload at DEBUG level, or for sampled invocations.
+    build_payload is only called (and serialized) when the payload is logged.
+    """
+    metrics = _invocation_metrics.get()
+    if logger.isEnabledFor(logging.DEBUG) or (metrics and metrics['sampled']):
+        logger.info(message, json.dumps(build_payload()))
 
-def fetch_recipes_in_category(folder_id):
-    """Fetch recipes from the selected category folder."""
-    query_params = {
-        'q': f"'{folder_id}' in parents and mimeType!='application/vnd.google-apps.folder'",
-        'key': API_KEY,
-        'fields': 'files(id, name)'
+def _metric_unit(name):
+    if name.endswith('_ms'):
+        return 'Milliseconds'
+    if name.endswith('_bytes'):
+        return 'Bytes'
+    if name.endswith('_ratio'):
+        return 'None'
+    return 'Count'
+
+def finish_invocation(metrics, response):
+    """Write the invocation's metrics as one EMF JSON line on stdout."""
+    global last_invocation_metrics, _pending_init_metrics
+    _invocation_metrics.set(None)
+    values = {f'{name}_ms': round(seconds * 1000, 3) for name, seconds in metrics['stages'].items()}
+    values['duration_ms'] = round((time.perf_counter() - metrics['started']) * 1000, 3)
+    values.update(metrics['counts'])
+    if _pending_init_metrics:
+        values.update(_pending_init_metrics)
+        _pending_init_metrics = None
+    if metrics['sampled']:
+        # Serializing the response is only worth paying for on sampled invocations
+        started = time.perf_counter()
+        values['response_bytes'] = len(json.dumps(response))
+        values['serialize_ms'] = round((time.perf_counter() - started) * 1000, 3)
+    # Hit ratios are the tenant's own, so one household's misses don't hide another's
+    tenant_id = metrics.get('tenant')
+    values['listing_cache_hit_ratio'] = round(listing_cache.stats(tenant_id)['hit_ratio'], 4)
+    values['content_cache_hit_ratio'] = round(content_cache.stats(tenant_id)['hit_ratio'], 4)
+    last_invocation_metrics = values
+    if not METRICS_ENABLED:
+        return
+
+    units = {name: _metric_unit(name) for name in values}
+    line = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['RequestType']],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, unit in units.items()]
+            }]
+        },
+        'RequestType': metrics['request_type'],
+        'Tenant': tenant_id,
+        **values
     }
-    query_string = urllib.parse.urlencode(query_params)
-    query_url = f'https://www.googleapis.com/drive/v3/files?{query_string}'
+    sys.stdout.write(json.dumps(line) + '\n')
+
+# === Deadlines ===
+
+# monotonic() time by which this invocation's fetches must finish; None in
+# background threads, which use the plain HTTP timeouts
+_deadline = contextvars.ContextVar('deadline', default=None)
+
+def set_deadline(context):
+    """Set the current invocation's deadline from the Lambda context."""
+    budget = RESPONSE_DEADLINE_SECONDS
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        budget = min(budget, context.get_remaining_time_in_millis() / 1000)
+    _deadline.set(time.monotonic() + budget - RESPONSE_RESERVE_SECONDS)
+
+def time_left():
+    """Seconds left before the current invocation's deadline, or None if it has none."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+# === Tenants ===
+
+class TenantRegistry:
+    """Tenants (households) by id, with the Alexa device and user ids that belong to each."""
 
-    logger.info("Fetching recipes with Folder ID: %s", folder_id)
-    logger.info("Fetching recipes with URL: %s", query_url)
+    def __init__(self, tenants, default=None):
+        self.tenants = tenants  # tenant id -> {'id', 'rootFolderId', 'apiKey'}
+        self.default = default
+        self._by_device = {}
+        self._by_user = {}
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as f:
+            config = json.load(f)
+        tenants = {}
+        registry = cls(tenants, config.get('default'))
+        for tenant_id, entry in config.get('tenants', {}).items():
+            tenants[tenant_id] = {'id': tenant_id, 'rootFolderId': entry['rootFolderId'], 'apiKey': entry.get('apiKey')}
+            registry._by_device.update((device_id, tenant_id) for device_id in entry.get('devices', []))
+            registry._by_user.update((user_id, tenant_id) for user_id in entry.get('users', []))
+        if registry.default is not None and registry.default not in tenants:
+            raise ValueError(f"Default tenant {registry.default} is not defined")
+        return registry
+
+    def resolve(self, device_id=None, user_id=None):
+        """
+        Return the tenant for a request, or None if it belongs to nobody.
+        A device belongs to the household it's registered to, whoever is talking to it.
+        """
+        tenant_id = self._by_device.get(device_id) or self._by_user.get(user_id) or self.default
+        return self.tenants.get(tenant_id)
+
+    def __len__(self):
+        return len(self.tenants)
+
+
+_tenant_registry = None
+_tenant_registry_lock = threading.Lock()
+
+def get_tenant_registry():
+    """Return the registry loaded from TENANTS_FILE, or None in single-tenant mode."""
+    global _tenant_registry
+    if _tenant_registry is None and TENANTS_FILE:
+        with _tenant_registry_lock:
+            if _tenant_registry is None:
+                _tenant_registry = TenantRegistry.load(TENANTS_FILE)
+                logger.info(f"Loaded {len(_tenant_registry)} tenants from {TENANTS_FILE}")
+    return _tenant_registry
+
+def resolve_tenant(event):
+    """Return the tenant an Alexa request belongs to, or None if it isn't registered."""
+    registry = get_tenant_registry()
+    if registry is None:
+        return default_tenant()
+    system = event.get('context', {}).get('System', {})
+    return registry.resolve(
+        device_id=system.get('device', {}).get('deviceId'),
+        user_id=system.get('user', {}).get('userId')
+    )
+
+def default_tenant():
+    """The tenant used outside of invocations: the registry's default, or API_KEY and ROOT_FOLDER_ID."""
+    registry = get_tenant_registry()
+    if registry is not None and registry.default is not None:
+        return registry.tenants[registry.default]
+    return {'id': DEFAULT_TENANT_ID, 'rootFolderId': ROOT_FOLDER_ID, 'apiKey': API_KEY}
+
+# The tenant the current invocation is serving. Threads start with an empty
+# context, so work handed to one is wrapped with in_tenant().
+_tenant = contextvars.ContextVar('tenant', default=None)
+
+def current_tenant():
+    return _tenant.get() or default_tenant()
+
+def tenant_api_key():
+    return current_tenant()['apiKey'] or API_KEY
+
+def tenant_key(*parts):
+    """A cache key in the current tenant's partition."""
+    return (current_tenant()['id'],) + parts
+
+def in_tenant(fn):
+    """
+    Wrap fn to run as the current tenant on another thread, without the
+    invocation's deadline or metrics.
+    """
+    tenant = current_tenant()
 
+    def run(*args, **kwargs):
+        _tenant.set(tenant)
+        return fn(*args, **kwargs)
+    return run
+
+# === HTTP Client ===
+
+class DeadlineExceeded(TimeoutError):
+    """Raised instead of starting a request the invocation has no time left for."""
+
+
+class HttpError(Exception):
+    """Raised for a non-2xx response once retries are exhausted."""
+
+    def __init__(self, status, reason, body=b''):
+        super().__init__(f'HTTP {status} {reason}')
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+
+_idle_connections = {}  # (scheme, netloc) -> [HTTPConnection]
+_idle_connections_lock = threading.Lock()
+
+def _acquire_connection(scheme, netloc, timeout):
+    """Return (connection, reused), preferring an idle keep-alive connection."""
+    with _idle_connections_lock:
+        idle = _idle_connections.get((scheme, netloc))
+        conn = idle.pop() if idle else None
+    if conn is not None:
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn, True
+    if scheme == 'https':
+        return http.client.HTTPSConnection(netloc, timeout=timeout), False
+    return http.client.HTTPConnection(netloc, timeout=timeout), False
+
+def preconnect(url, timeout=HTTP_TIMEOUT_SECONDS):
+    """Open a connection to url's host and park it in the idle pool."""
+    parts = urllib.parse.urlsplit(url)
+    conn, _ = _acquire_connection(parts.scheme, parts.netloc, timeout)
     try:
-        with urllib.request.urlopen(query_url) as response:
-            data = json.loads(response.read().decode())
-        logger.info("Recipe API Response: %s", json.dumps(data, indent=2))
+        conn.connect()
+    except OSError as e:
+        conn.close()
+        logger.warning(f"Could not preconnect to {parts.netloc}: {e}")
+        return False
+    _release_connection(parts.scheme, parts.netloc, conn)
+    return True
 
-        # Create a dictionary with file names and IDs
-        file_names = {file['name']: file['id'] for file in data.get('files', [])}
-        
-        # Sort the file names alphabetically
-        sorted_file_names = sorted(file_names.keys())
+def _release_connection(scheme, netloc, conn):
+    with _idle_connections_lock:
+        idle = _idle_connections.setdefault((scheme, netloc), [])
+        if len(idle) < HTTP_IDLE_CONNECTIONS_PER_HOST:
+            idle.append(conn)
+            return
+    conn.close()
+
+def _retry_delay(attempt, retry_after=None):
+    """Full-jitter exponential backoff, honouring a numeric Retry-After."""
+    if retry_after and retry_after.isdigit():
+        return min(int(retry_after), HTTP_MAX_RETRY_AFTER_SECONDS)
+    return random.uniform(0, HTTP_BACKOFF_SECONDS * (2 ** attempt))
+
+def _wait_before_retry(delay):
+    """Sleep before a retry, or return False if the deadline would pass first."""
+    remaining = time_left()
+    if remaining is not None and delay >= remaining:
+        return False
+    time.sleep(delay)
+    return True
+
+def http_request(url, method='GET', headers=None, body=None, timeout=HTTP_TIMEOUT_SECONDS, retries=HTTP_MAX_RETRIES):
+    """
+    Send a request over a pooled keep-alive connection and return (status, body).
+    Raises HttpError for 4xx/5xx responses and OSError for network failures.
+    A 304 Not Modified is returned rather than raised. Each attempt's timeout
+    is cut to the time left before the invocation's deadline, and
+    DeadlineExceeded is raised once none is left.
+    """
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path + (f'?{parts.query}' if parts.query else '')
+    request_headers = {'Accept-Encoding': 'gzip', 'User-Agent': HTTP_USER_AGENT}
+    request_headers.update(headers or {})
+
+    for attempt in range(retries + 1):
+        remaining = time_left()
+        if remaining is not None and remaining <= 0:
+            count('deadline_exceeded')
+            raise DeadlineExceeded(f"No time left for {method} {parts.netloc}{parts.path}")
+        attempt_timeout = timeout if remaining is None else min(timeout, remaining)
+        count('http_requests')
+        conn, reused = _acquire_connection(parts.scheme, parts.netloc, attempt_timeout)
+        try:
+            conn.request(method, path, body=body, headers=request_headers)
+            response = conn.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError) as e:
+            conn.close()
+            # A pooled connection the server had already closed fails before the
+            # request is read, so it is always safe to retry (at once); any other
+            # failure is only retried for requests that are safe to repeat
+            stale = reused and isinstance(e, HTTP_STALE_CONNECTION_ERRORS)
+            if attempt == retries or not (stale or method == 'GET'):
+                raise
+            if not stale and not _wait_before_retry(_retry_delay(attempt)):
+                raise
+            logger.warning(f"Retrying {method} {parts.netloc}{parts.path} after error: {e}")
+            continue
+
+        if response.will_close:
+            conn.close()
+        else:
+            _release_connection(parts.scheme, parts.netloc, conn)
+
+        if response.getheader('Content-Encoding') == 'gzip':
+            data = gzip.decompress(data)
+
+        retry_statuses = HTTP_RETRY_STATUSES if method == 'GET' else HTTP_UNSAFE_RETRY_STATUSES
+        if response.status in retry_statuses and attempt < retries:
+            if _wait_before_retry(_retry_delay(attempt, response.getheader('Retry-After'))):
+                logger.warning(f"Retrying {method} {parts.netloc}{parts.path} after HTTP {response.status}")
+                continue
+        if response.status >= 400:
+            raise HttpError(response.status, response.reason, data)
+        return response.status, data
+
+def http_get_json(url, timeout=HTTP_TIMEOUT_SECONDS):
+    """GET a URL through the shared client and decode the JSON body."""
+    _, data = http_request(url, timeout=timeout)
+    return json.loads(data.decode('utf-8'))
+
+# === Caching ===
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key: the first caller runs the
+    function and the others wait for its result (or exception) instead of
+    repeating the same Drive request. Waiters give up with DeadlineExceeded
+    when their invocation's deadline passes first.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._calls = {}  # key -> {'done': Event, 'value' or 'error'}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event()}
+            else:
+                self.coalesced += 1
+        if not leader:
+            count('coalesced_fetches')
+            # The call joined may be a background fetch with no deadline of its own
+            remaining = time_left()
+            if not call['done'].wait(None if remaining is None else max(0, remaining)):
+                count('deadline_exceeded')
+                raise DeadlineExceeded(f"No time left waiting for {key}")
+            if 'error' in call:
+                raise call['error']
+            return call['value']
+
+        try:
+            call['value'] = fn()
+            return call['value']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+
+
+class PartitionedLRU:
+    """
+    LRU map for (partition, ...) tuple keys, e.g. (tenant_id, file_id). No
+    partition may hold more than partition_max_size, and once the total passes
+    max_size the largest partition gives up its least recently used entry
+    first. Sizes are entry counts unless set() is given one. Callers lock.
+    """
+
+    def __init__(self, max_size, partition_max_size=None):
+        self.max_size = max_size
+        self.partition_max_size = min(partition_max_size or max_size, max_size)
+        self.size = 0
+        self._partitions = {}  # partition -> OrderedDict(key -> (value, size))
+        self._sizes = Counter()
+
+    def get(self, key, touch=True):
+        entries = self._partitions.get(key[0])
+        item = entries.get(key) if entries else None
+        if item is None:
+            return None
+        if touch:
+            entries.move_to_end(key)
+        return item[0]
+
+    def set(self, key, value, size=1):
+        """Store a value and evict over the limits; returns False if it is too big to keep."""
+        self.pop(key)
+        if size > self.partition_max_size:
+            return False
+        partition = key[0]
+        self._partitions.setdefault(partition, OrderedDict())[key] = (value, size)
+        self._sizes[partition] += size
+        self.size += size
+        while self._sizes[partition] > self.partition_max_size:
+            self._evict(partition)
+        while self.size > self.max_size:
+            self._evict(max(self._sizes, key=self._sizes.get))
+        return True
+
+    def pop(self, key):
+        entries = self._partitions.get(key[0])
+        item = entries.pop(key, None) if entries else None
+        if item is None:
+            return None
+        self._shrink(key[0], item[1])
+        return item[0]
+
+    def _evict(self, partition):
+        _, (_, size) = self._partitions[partition].popitem(last=False)
+        self._shrink(partition, size)
+
+    def _shrink(self, partition, size):
+        self.size -= size
+        self._sizes[partition] -= size
+        if not self._partitions[partition]:
+            del self._partitions[partition]
+            del self._sizes[partition]
+
+    def clear(self):
+        self._partitions.clear()
+        self._sizes.clear()
+        self.size = 0
+
+    def partition_size(self, partition):
+        return self._sizes.get(partition, 0)
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._partitions.values())
+
+
+class TTLCache:
+    """
+    Bounded LRU cache with per-entry TTLs and stale-while-revalidate reads.
+    Keys are (partition, ...) tuples; see PartitionedLRU for the limits.
+    """
+
+    def __init__(self, max_entries, ttl, stale_ttl=0, partition_max_entries=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self._entries = PartitionedLRU(max_entries, partition_max_entries)  # key -> (value, fresh_until, stale_until)
+        self._partition_counts = {}  # partition -> Counter of hits, stale_hits and misses
+        self._refreshing = set()
+        self._flights = SingleFlight()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return (value, state) where state is 'fresh', 'stale' or None on a miss.
+        Expired entries count as misses but are kept (until evicted) as a
+        fallback for get_or_load.
+        """
+        now = time.monotonic()
+        with self._lock:
+            counts = self._partition_counts.setdefault(key[0], Counter())
+            entry = self._entries.get(key, touch=False)
+            if entry is None or now >= entry[2]:
+                self.misses += 1
+                counts['misses'] += 1
+                return None, None
+            self._entries.get(key)
+            if now < entry[1]:
+                self.hits += 1
+                counts['hits'] += 1
+                return entry[0], 'fresh'
+            self.stale_hits += 1
+            counts['stale_hits'] += 1
+            return entry[0], 'stale'
+
+    def set(self, key, value, ttl=None):
+        """Store a value, evicting the least recently used entries over the limits."""
+        ttl = self.ttl if ttl is None else ttl
+        now = time.monotonic()
+        with self._lock:
+            self._entries.set(key, (value, now + ttl, now + ttl + self.stale_ttl))
+
+    def contains(self, key):
+        """Return True if key has a fresh entry, without touching the counters."""
+        with self._lock:
+            entry = self._entries.get(key, touch=False)
+        return entry is not None and time.monotonic() < entry[1]
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_or_load(self, key, loader, ttl=None):
+        """
+        Return the cached value for key, calling loader() on a miss.
+        Concurrent misses for the same key share one loader() call. Stale
+        values are returned immediately and refreshed in the background. If
+        loader() fails, an expired value is returned in its place when one is
+        still held; the next lookup tries loader() again.
+        """
+        value, state = self.get(key)
+        if state == 'fresh':
+            return value
+        if state == 'stale':
+            self._refresh_in_background(key, loader, ttl)
+            return value
+        try:
+            return self._flights.do(key, lambda: self._load(key, loader, ttl))
+        except Exception as e:
+            with self._lock:
+                entry = self._entries.get(key, touch=False)
+            if entry is None:
+                raise
+            logger.warning(f"Serving expired {key} after: {e}")
+            count('stale_fallbacks')
+            return entry[0]
+
+    def _load(self, key, loader, ttl):
+        value = loader()
+        self.set(key, value, ttl)
+        return value
+
+    def _refresh_in_background(self, key, loader, ttl):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                self.set(key, loader(), ttl)
+            except Exception as e:
+                logger.error(f"Background refresh failed for {key}: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=in_tenant(refresh), daemon=True).start()
+
+    def stats(self, partition=None):
+        """Return hit/miss counters and the entry count, for one partition or the whole cache."""
+        if partition is None:
+            hits, stale_hits, misses = self.hits, self.stale_hits, self.misses
+            entries = len(self._entries)
+        else:
+            counts = self._partition_counts.get(partition, Counter())
+            hits, stale_hits, misses = counts['hits'], counts['stale_hits'], counts['misses']
+            entries = self._entries.partition_size(partition)
+        lookups = hits + stale_hits + misses
+        return {
+            'hits': hits,
+            'stale_hits': stale_hits,
+            'misses': misses,
+            'entries': entries,
+            'coalesced': self._flights.coalesced,
+            'hit_ratio': (hits + stale_hits) / lookups if lookups else 0.0
+        }
+
+
+SAFE_ID_PATTERN = re.compile(r'[^A-Za-z0-9_-]')
+
+class FileContentStore:
+    """
+    Persistent content tier: one JSON file per recipe under a /tmp directory,
+    in a subdirectory per tenant. Each tenant's files are held to
+    partition_max_bytes, and the directory as a whole to max_bytes by deleting
+    the oldest files of whichever tenant uses the most. Byte totals are kept
+    as files are written, so the directory is only scanned (on a background
+    thread) when it goes over budget.
+    """
+
+    def __init__(self, cache_dir, max_bytes, partition_max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.partition_max_bytes = min(partition_max_bytes or max_bytes, max_bytes)
+        self._usage = None  # tenant directory -> bytes, None until the first scan
+        self._total = 0
+        self._pruning = False
+        self._lock = threading.Lock()
+
+    def _tenant_dir(self, tenant_id):
+        return os.path.join(self.cache_dir, SAFE_ID_PATTERN.sub('_', tenant_id))
+
+    def _path(self, tenant_id, file_id):
+        safe_id = SAFE_ID_PATTERN.sub('_', file_id)
+        return os.path.join(self._tenant_dir(tenant_id), f'{safe_id}.json')
+
+    def get(self, tenant_id, file_id):
+        try:
+            with open(self._path(tenant_id, file_id), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, entry):
+        path = self._path(entry['tenant'], entry['id'])
+        tenant_dir = os.path.dirname(path)
+        data = json.dumps(entry).encode('utf-8')
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        os.makedirs(tenant_dir, exist_ok=True)
+        try:
+            old_size = os.stat(path).st_size
+        except FileNotFoundError:
+            old_size = 0
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if self._usage is None:
+                over = True  # Sizes aren't known until the first scan
+            else:
+                self._usage[tenant_dir] = self._usage.get(tenant_dir, 0) + len(data) - old_size
+                self._total += len(data) - old_size
+                over = self._usage[tenant_dir] > self.partition_max_bytes or self._total > self.max_bytes
+            if not over or self._pruning:
+                return
+            self._pruning = True
+        threading.Thread(target=self._prune, args=(tenant_dir,), daemon=True).start()
+
+    @staticmethod
+    def _cache_files(directory):
+        """Return [(size, path)] for a tenant's cache files, oldest first."""
+        files = []
+        for entry in os.scandir(directory):
+            # Other threads' .tmp files are renamed away underneath us, and a
+            # concurrent prune may already have removed a cache file
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        return [(size, path) for _, size, path in sorted(files)]
+
+    def _prune(self, tenant_dir):
+        """
+        Delete the oldest cache files of tenants over their byte budget, and
+        reset the byte totals from what is left.
+        """
+        try:
+            usage = {}  # tenant directory -> [files oldest first, bytes]
+            for entry in os.scandir(self.cache_dir):
+                if entry.is_dir():
+                    files = self._cache_files(entry.path)
+                    usage[entry.path] = [files, sum(size for size, _ in files)]
+            total = sum(used for _, used in usage.values())
+
+            def remove_oldest(directory):
+                nonlocal total
+                files = usage[directory][0]
+                size, path = files.pop(0)
+                usage[directory][1] -= size
+                total -= size
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+            while tenant_dir in usage and usage[tenant_dir][1] > self.partition_max_bytes:
+                remove_oldest(tenant_dir)
+            while total > self.max_bytes:
+                remove_oldest(max(usage, key=lambda directory: usage[directory][1]))
+            with self._lock:
+                # Puts that landed during the scan may be missed; the next prune counts them
+                self._usage = {directory: used for directory, (_, used) in usage.items()}
+                self._total = total
+        except Exception as e:
+            logger.error(f"Error pruning content cache: {e}")
+        finally:
+            with self._lock:
+                self._pruning = False
+
+
+class SqliteContentStore:
+    """
+    Persistent content tier backed by SQLite, standing in for a shared store
+    such as DynamoDB. Text is stored zlib-compressed.
+    """
+
+    def __init__(self, path):
+        import sqlite3
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS tenant_recipes '
+            '(tenant TEXT, id TEXT, modified_time TEXT, content BLOB, PRIMARY KEY (tenant, id))'
+        )
+        self._lock = threading.Lock()
+
+    def get(self, tenant_id, file_id):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT modified_time, content FROM tenant_recipes WHERE tenant = ? AND id = ?', (tenant_id, file_id)
+            ).fetchone()
+        if row is None:
+            return None
+        return {'tenant': tenant_id, 'id': file_id, 'modifiedTime': row[0], 'content': zlib.decompress(row[1]).decode('utf-8')}
+
+    def put(self, entry):
+        blob = zlib.compress(entry['content'].encode('utf-8'))
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO tenant_recipes (tenant, id, modified_time, content) VALUES (?, ?, ?, ?)',
+                (entry['tenant'], entry['id'], entry['modifiedTime'], blob)
+            )
+
+
+class ContentCache:
+    """
+    Two-tier cache for cleaned recipe text: a size-bounded in-memory LRU in
+    front of a persistent store that survives between warm invocations.
+    Keys are (tenant_id, file_id); memory is partitioned by tenant like
+    PartitionedLRU, with sizes in bytes.
+    """
+
+    def __init__(self, max_memory_bytes, store=None, partition_max_bytes=None):
+        self.max_memory_bytes = max_memory_bytes
+        self.store = store
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = PartitionedLRU(max_memory_bytes, partition_max_bytes)  # key -> (modified_time, content)
+        self._partition_counts = {}  # tenant_id -> Counter of memory_hits, disk_hits and misses
+        self._lock = threading.Lock()
+
+    def _count(self, key, outcome):
+        setattr(self, outcome, getattr(self, outcome) + 1)
+        self._partition_counts.setdefault(key[0], Counter())[outcome] += 1
+
+    def get(self, key, modified_time):
+        """Return the cached content for this version of the file, or None."""
+        with self._lock:
+            entry = self._memory.get(key, touch=False)
+            if entry and entry[0] == modified_time:
+                self._memory.get(key)
+                self._count(key, 'memory_hits')
+                return entry[1]
+
+        entry = self._read_store(key)
+        if entry and entry.get('modifiedTime') == modified_time:
+            self.prime(key, modified_time, entry['content'])
+            with self._lock:
+                self._count(key, 'disk_hits')
+            return entry['content']
 
-        return sorted_file_names, file_names
+        with self._lock:
+            self._count(key, 'misses')
+        return None
+
+    def latest(self, key):
+        """Return (modified_time, content) for whichever version is cached, or None."""
+        with self._lock:
+            entry = self._memory.get(key, touch=False)
+        if entry:
+            return entry[0], entry[1]
+        entry = self._read_store(key)
+        if entry:
+            return entry.get('modifiedTime'), entry['content']
+        return None
+
+    def put(self, key, modified_time, content):
+        self.prime(key, modified_time, content)
+        self.persist(key, modified_time, content)
+
+    def prime(self, key, modified_time, content):
+        """Cache content in memory only."""
+        size = len(content.encode('utf-8'))
+        with self._lock:
+            self._memory.set(key, (modified_time, content), size)
+
+    def persist(self, key, modified_time, content):
+        """Write content to the persistent store only."""
+        if self.store is None:
+            return
+        tenant_id, file_id = key
+        try:
+            self.store.put({'tenant': tenant_id, 'id': file_id, 'modifiedTime': modified_time, 'content': content})
+        except Exception as e:
+            logger.error(f"Error writing cached content for ID {file_id}: {e}")
+
+    def _read_store(self, key):
+        if self.store is None:
+            return None
+        try:
+            return self.store.get(*key)
+        except Exception as e:
+            logger.error(f"Error reading cached content for ID {key[1]}: {e}")
+            return None
+
+    def stats(self, partition=None):
+        """Return hit/miss counters and memory use, for one tenant or the whole cache."""
+        if partition is None:
+            memory_hits, disk_hits, misses = self.memory_hits, self.disk_hits, self.misses
+            memory_bytes = self._memory.size
+        else:
+            counts = self._partition_counts.get(partition, Counter())
+            memory_hits, disk_hits, misses = counts['memory_hits'], counts['disk_hits'], counts['misses']
+            memory_bytes = self._memory.partition_size(partition)
+        lookups = memory_hits + disk_hits + misses
+        return {
+            'memory_hits': memory_hits,
+            'disk_hits': disk_hits,
+            'misses': misses,
+            'memory_bytes': memory_bytes,
+            'hit_ratio': (memory_hits + disk_hits) / lookups if lookups else 0.0
+        }
+
+
+def create_recipe_store():
+    """Create the persistent content tier selected by RECIPE_STORE."""
+    try:
+        if RECIPE_STORE == 'sqlite':
+            return SqliteContentStore(RECIPE_STORE_SQLITE_PATH)
+        if RECIPE_STORE == 'file':
+            return FileContentStore(CONTENT_CACHE_DIR, CONTENT_DISK_MAX_BYTES, TENANT_CONTENT_DISK_MAX_BYTES)
     except Exception as e:
-        logger.error("Error fetching recipes: %s", e)
-        return [], {}
+        logger.error(f"Error opening recipe store {RECIPE_STORE}: {e}")
+    return None
 
-def download_file_content(file_id):
-    """Download the content of a Google Docs file."""
-    download_url = f'https://www.googleapis.com/drive/v3/files/{file_id}/export?mimeType=text/plain&key={API_KEY}'
+
+# Exports in flight, so devices opening the same recipe at once share one export
+export_flights = SingleFlight()
+
+listing_cache = TTLCache(LISTING_CACHE_MAX_ENTRIES, LISTING_TTL_SECONDS, LISTING_STALE_SECONDS, TENANT_LISTING_MAX_ENTRIES)
+content_cache = ContentCache(CONTENT_MEMORY_MAX_BYTES, create_recipe_store(), TENANT_CONTENT_MEMORY_MAX_BYTES)
+recipe_layout_cache = TTLCache(
+    RECIPE_LAYOUT_CACHE_MAX_ENTRIES, RECIPE_LAYOUT_TTL_SECONDS, partition_max_entries=TENANT_RECIPE_LAYOUT_MAX_ENTRIES
+)
+
+# === Prefetch ===
+
+# How often each folder or recipe id has been opened in this container
+usage_counts = Counter()
+
+_prefetch_executor = None
+_prefetch_in_flight = set()  # (tenant_id, file_id)
+_prefetch_lock = threading.Lock()
+
+def _prefetch_pool():
+    global _prefetch_executor
+    if _prefetch_executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix='prefetch')
+    return _prefetch_executor
+
+def _prefetch_recipe(file_id, deadline):
     try:
-        logger.info(f"Fetching file content from URL: {download_url}")
-        with urllib.request.urlopen(download_url) as response:
-            content = response.read().decode()
-            clean_content = clean_recipe_content(content)
-            logger.info(f"Recipe content for ID {file_id} fetched successfully.")
-            return clean_content
-    except urllib.error.HTTPError as e:
-        logger.error(f"HTTPError fetching file ID {file_id}: {e.reason}")
-        return "Sorry, I couldn't fetch the content of this recipe. Please try again later."
+        # Tasks still queued when the budget runs out are dropped
+        if time.monotonic() >= deadline:
+            return
+        fetch_recipe_content(file_id)
     except Exception as e:
-        logger.error(f"Error fetching file content for ID {file_id}: {e}")
-        return "An error occurred while fetching the recipe content."
+        logger.error(f"Prefetch of recipe {file_id} failed: {e}")
+    finally:
+        with _prefetch_lock:
+            _prefetch_in_flight.discard(tenant_key(file_id))
 
-def is_folder(file_id):
-    """Check if the given ID belongs to a folder."""
-    query_url = f'https://www.googleapis.com/drive/v3/files/{file_id}?fields=mimeType&key={API_KEY}'
+def schedule_refresh(file_id):
+    """Fetch one recipe again on the prefetch pool, e.g. after serving a stale copy of it."""
+    with _prefetch_lock:
+        if tenant_key(file_id) in _prefetch_in_flight:
+            return
+        _prefetch_in_flight.add(tenant_key(file_id))
+    _prefetch_pool().submit(in_tenant(_prefetch_recipe), file_id, time.monotonic() + PREFETCH_BUDGET_SECONDS)
+
+def schedule_prefetch(recipes):
+    """Warm the content cache for the recipes most likely to be opened next."""
+    if not PREFETCH_ENABLED or not recipes:
+        return
+    # Each recipe is a metadata check plus an export
+    cost = 2
+    deadline = time.monotonic() + PREFETCH_BUDGET_SECONDS
+    requests_left = PREFETCH_MAX_REQUESTS
+
+    # sorted() is stable, so unused recipes keep their on-screen order
+    ranked = sorted(recipes, key=lambda recipe: -usage_counts[recipe['id']])
+    for recipe in ranked[:PREFETCH_TOP_N]:
+        if requests_left < cost:
+            break
+        file_id = recipe['id']
+        if listing_cache.contains(tenant_key('file', file_id)):
+            continue
+        with _prefetch_lock:
+            if tenant_key(file_id) in _prefetch_in_flight:
+                continue
+            _prefetch_in_flight.add(tenant_key(file_id))
+        requests_left -= cost
+        _prefetch_pool().submit(in_tenant(_prefetch_recipe), file_id, deadline)
+
+# === Search ===
+
+# Search and title indexes by tenant id
+_search_indexes = {}
+_search_index_saved_at = {}
+_search_index_lock = threading.Lock()
+_title_indexes = {}
+
+def search_index_path(tenant_id):
+    """Where a tenant's search index is saved; the default tenant uses SEARCH_INDEX_PATH itself."""
+    if tenant_id == DEFAULT_TENANT_ID:
+        return SEARCH_INDEX_PATH
+    root, ext = os.path.splitext(SEARCH_INDEX_PATH)
+    return f"{root}-{SAFE_ID_PATTERN.sub('_', tenant_id)}{ext}"
+
+def load_search_index(tenant):
+    """
+    Load the newest usable saved index of the tenant's recipes: the one bundled
+    with its snapshot or the one saved to /tmp. Returns an empty index if neither is.
+    """
+    from recipe_search import SearchIndex
+    bundled = snapshot_filename(tenant['rootFolderId'], SNAPSHOT_INDEX_FILENAME)
+    paths = [os.path.join(directory, bundled) for directory in SNAPSHOT_DIRS] + [search_index_path(tenant['id'])]
+    for path in sorted(filter(os.path.exists, paths), key=os.path.getmtime, reverse=True):
+        index = SearchIndex.load(path)
+        if len(index):
+            logger.info(f"Loaded search index for {tenant['id']} with {len(index)} recipes from {path}")
+            return index
+    return SearchIndex()
+
+def get_search_index():
+    """Return the current tenant's search index, loading it on first use."""
+    tenant = current_tenant()
+    index = _search_indexes.get(tenant['id'])
+    if index is None:
+        with _search_index_lock:
+            index = _search_indexes.get(tenant['id'])
+            if index is None:
+                index = _search_indexes[tenant['id']] = load_search_index(tenant)
+    return index
+
+def get_title_index():
+    tenant_id = current_tenant()['id']
+    index = _title_indexes.get(tenant_id)
+    if index is None:
+        with _search_index_lock:
+            index = _title_indexes.get(tenant_id)
+            if index is None:
+                from recipe_search import TitleIndex
+                index = _title_indexes[tenant_id] = TitleIndex()
+    return index
+
+def index_titles(folder_id, recipes):
+    """Bring the title index up to date with a folder's recipe listing."""
+    removed = get_title_index().update_folder(folder_id, recipes)
+    if removed:
+        # Deleted, trashed or moved away: stop finding them in searches too
+        index = get_search_index()
+        for file_id in removed:
+            index.remove(file_id)
+        logger.debug("Removed %d recipes no longer in folder %s", len(removed), folder_id)
+        schedule_search_index_save(index)
+
+def schedule_search_crawl(file_ids):
+    """Read some of the recipes missing from the search index on the prefetch pool."""
+    deadline = time.monotonic() + SEARCH_CRAWL_BUDGET_SECONDS
+    scheduled = 0
+    for file_id in file_ids:
+        if scheduled >= SEARCH_CRAWL_MAX_RECIPES:
+            break
+        with _prefetch_lock:
+            if tenant_key(file_id) in _prefetch_in_flight:
+                continue
+            _prefetch_in_flight.add(tenant_key(file_id))
+        scheduled += 1
+        _prefetch_pool().submit(in_tenant(_prefetch_recipe), file_id, deadline)
+
+def _save_search_index(index, path):
     try:
-        logger.info(f"Checking if file ID {file_id} is a folder...")
-        with urllib.request.urlopen(query_url) as response:
-            data = json.loads(response.read().decode())
-            mime_type = data.get('mimeType')
-            logger.info(f"Mime type for ID {file_id}: {mime_type}")
-            
-            # Validate mime_type before returning
-            if mime_type == 'application/vnd.google-apps.folder':
-                return True
-            return False
+        index.save(path)
     except Exception as e:
-        logger.error(f"Error checking if ID {file_id} is a folder: {e}")
-        return False
+        logger.error(f"Error saving search index: {e}")
 
-def display_categories():
-    sorted_folder_names, folder_ids = fetch_subfolders()
+def index_recipe(file_id, name, modified_time, content):
+    """Add a recipe version to the search index and persist it periodically."""
+    index = get_search_index()
+    if index.update(file_id, name, modified_time, content):
+        schedule_search_index_save(index)
 
-    if not sorted_folder_names:
-        return {
-            'version': '1.0',
-            'response': {
-                'directives': [],
-                'shouldEndSession': True
-            }
-        }
+def schedule_search_index_save(index):
+    """Save the current tenant's changed search index, at most once per SEARCH_INDEX_SAVE_INTERVAL_SECONDS."""
+    tenant_id = current_tenant()['id']
+    now = time.monotonic()
+    if now - _search_index_saved_at.get(tenant_id, 0.0) < SEARCH_INDEX_SAVE_INTERVAL_SECONDS:
+        return
+    _search_index_saved_at[tenant_id] = now
+    # Written off the request thread; a lost write is repaired the next time the recipe is opened
+    threading.Thread(target=_save_search_index, args=(index, search_index_path(tenant_id)), daemon=True).start()
+
+# === Snapshot ===
+
+# The snapshot loaded for each tenant id, as {'rootId', 'createdAt'}; {} for
+# tenants without one. Its listings and text are handed to the bounded caches
+# and the search index rather than kept here.
+_snapshots = {}
+_snapshot_locks = {}
+
+def snapshot_filename(root_id, filename=SNAPSHOT_FILENAME):
+    """The file name build_snapshot.py writes a root folder's snapshot (or its search index) to."""
+    root, ext = filename.split('.', 1)
+    return f"{root}-{SAFE_ID_PATTERN.sub('_', root_id)}.{ext}"
+
+def snapshot_paths(tenant):
+    """The files that may hold a snapshot of the tenant's root folder."""
+    filenames = [snapshot_filename(tenant['rootFolderId'])]
+    if tenant['id'] == DEFAULT_TENANT_ID:
+        filenames.append(SNAPSHOT_FILENAME)
+    return [os.path.join(directory, filename) for directory in SNAPSHOT_DIRS for filename in filenames]
+
+def read_snapshot(path):
+    """Read a snapshot file, returning None if it is missing or unusable."""
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error(f"Error reading snapshot {path}: {e}")
+        return None
+    if snapshot.get('version') != SNAPSHOT_FORMAT_VERSION:
+        logger.error(f"Ignoring snapshot {path} with version {snapshot.get('version')}")
+        return None
+    return snapshot
+
+def write_snapshot(snapshot, path):
+    tmp_path = f'{path}.tmp'
+    with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+        json.dump(snapshot, f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+def _prime_from_snapshot(snapshot):
+    """Load the snapshot's listings into the caches as stale entries."""
+    children = {}
+    # Items are [id, parent_id, name, mimeType, modifiedTime], already sorted by name
+    for file_id, parent_id, name, mime_type, modified_time in snapshot['items']:
+        kind = 'folder' if mime_type == FOLDER_MIME_TYPE else 'recipe'
+        item_kinds[file_id] = kind
+        children.setdefault(parent_id, []).append({'id': file_id, 'name': name, 'kind': kind})
+
+    root_id = snapshot['rootId']
+    folders = [{'id': item['id'], 'name': item['name']} for item in children.get(root_id, []) if item['kind'] == 'folder']
+    listing_cache.set(tenant_key('subfolders', root_id), folders, ttl=0)
+    for folder in folders:
+        recipes = [{'id': item['id'], 'name': item['name']} for item in children.get(folder['id'], []) if item['kind'] == 'recipe']
+        listing_cache.set(tenant_key('recipes', folder['id']), recipes, ttl=0)
+        index_titles(folder['id'], recipes)
+
+def _load_snapshot_content(names, content):
+    """Index the snapshot's recipe text and write it to the content cache's store."""
+    for file_id, (modified_time, text) in content.items():
+        index_recipe(file_id, names.get(file_id), modified_time, text)
+        content_cache.persist(tenant_key(file_id), modified_time, text)
+
+def get_snapshot():
+    """Load the newest snapshot of the current tenant's root folder once per container, priming the caches."""
+    tenant = current_tenant()
+    snapshot = _snapshots.get(tenant['id'])
+    if snapshot is None:
+        # Tenants load their own files, so one tenant's snapshot never waits on another's
+        with _snapshot_locks.setdefault(tenant['id'], threading.Lock()):
+            snapshot = _snapshots.get(tenant['id'])
+            if snapshot is None:
+                candidates = [read_snapshot(path) for path in snapshot_paths(tenant)]
+                candidates = [c for c in candidates if c and c.get('rootId') == tenant['rootFolderId']]
+                if candidates:
+                    loaded = max(candidates, key=lambda c: c.get('createdAt', ''))
+                    _prime_from_snapshot(loaded)
+                    content = loaded.get('content')
+                    if content:
+                        # Held in memory (within the tenant's share) at once; the
+                        # copy in the store and the index entries follow
+                        for file_id, (modified_time, text) in content.items():
+                            content_cache.prime(tenant_key(file_id), modified_time, text)
+                        names = {item[0]: item[2] for item in loaded['items']}
+                        threading.Thread(target=in_tenant(_load_snapshot_content), args=(names, content), daemon=True).start()
+                    logger.info(f"Loaded snapshot from {loaded.get('createdAt')} with {len(loaded['items'])} items")
+                    snapshot = {'rootId': loaded['rootId'], 'createdAt': loaded.get('createdAt')}
+                else:
+                    snapshot = {}
+                _snapshots[tenant['id']] = snapshot
+    return snapshot
 
-    document = {
+# === APL Templates ===
+# Layouts are built once at module load and bound to per-response datasources,
+# so each response only builds the data that actually changes.
+
+APL_SETTINGS = {
+    'idleTimeout': 3600000,  # Keep the screen active
+    'handleKeyEvents': False  # Disable implicit handling of input events
+}
+
+def _list_item_template(kind, max_lines=None):
+    """A touchable list row that sends [id, kind, name] back to the skill."""
+    text = {
+        'type': 'Text',
+        'text': '${data.name}',
+        'style': 'textStylePrimary1',
+        'paddingTop': '10dp',
+        'paddingBottom': '10dp',
+        'paddingLeft': '20dp',
+        'paddingRight': '20dp'
+    }
+    if max_lines:
+        text['maxLines'] = max_lines
+    return {
+        'type': 'TouchWrapper',
+        'onPress': {
+            'type': 'SendEvent',
+            'arguments': ['${data.id}', kind, '${data.name}']
+        },
+        'item': text
+    }
+
+def _list_document(parameter, data, kind, max_lines=None):
+    return {
         'type': 'APL',
         'version': '2024.2',
-        'settings': {
-            'idleTimeout': 3600000,
-            'handleKeyEvents': False  # Disable implicit handling of input events
-        },
+        'settings': APL_SETTINGS,
         'mainTemplate': {
-            'parameters': [],
+            'parameters': [parameter],
             'items': [
                 {
                     'type': 'Container',
@@ -143,28 +1359,14 @@ def display_categories():
                     'height': '100%',
                     'items': [
                         {
+                            # The Sequence is the scrolling container so the device
+                            # can request more of a dynamic list as it scrolls
                             'type': 'Sequence',
                             'scrollDirection': 'vertical',
                             'width': '100%',
                             'height': '100%',
-                            'items': [
-                                {
-                                    'type': 'TouchWrapper',
-                                    'onPress': {
-                                        'type': 'SendEvent',
-                                        'arguments': [folder_ids[folder_name]]
-                                    },
-                                    'item': {
-                                        'type': 'Text',
-                                        'text': folder_name,
-                                        'style': 'textStylePrimary1',
-                                        'paddingTop': '10dp',
-                                        'paddingBottom': '10dp',
-                                        'paddingLeft': '20dp',
-                                        'paddingRight': '20dp'
-                                    }
-                                } for folder_name in sorted_folder_names
-                            ]
+                            'data': data,
+                            'item': _list_item_template(kind, max_lines)
                         }
                     ]
                 }
@@ -172,24 +1374,381 @@ def display_categories():
         }
     }
 
-    return {
-        'version': '1.0',
-        'response': {
-            'directives': [
+APL_DOCUMENTS = {
+    'categoryList': _list_document('categoryList', '${categoryList.items}', 'folder'),
+    'recipeList': _list_document('recipeList', '${recipeList}', 'recipe', max_lines=1),
+    'recipeContent': {
+        'type': 'APL',
+        'version': '2024.2',
+        'settings': {'idleTimeout': 3600000},
+        'mainTemplate': {
+            'parameters': ['recipe'],
+            'items': [
                 {
-                    'type': 'Alexa.Presentation.APL.RenderDocument',
-                    'document': document
+                    'type': 'Sequence',
+                    'id': RECIPE_COMPONENT_ID,
+                    'width': '100%',
+                    'height': '100%',
+                    'paddingLeft': '20dp',
+                    'paddingRight': '20dp',
+                    'paddingTop': '20dp',
+                    'paddingBottom': '20dp',
+                    'data': '${recipe.rows}',
+                    'items': [
+                        {
+                            'when': "${data.type == 'heading'}",
+                            'type': 'Text',
+                            'text': '${data.text}',
+                            'style': 'textStyleDisplay4',
+                            'paddingTop': '20dp',
+                            'paddingBottom': '10dp'
+                        },
+                        {
+                            'type': 'Text',
+                            'text': '${data.text}',
+                            'style': 'textStylePrimary1',
+                            'paddingBottom': '6dp'
+                        }
+                    ]
                 }
-            ],
-            'shouldEndSession': False
+            ]
+        }
+    }
+}
+
+# When set, documents are referenced by name from the skill's saved APL
+# documents (upload the APL_DOCUMENTS entries in the authoring tool) instead of
+# being sent inline with every RenderDocument.
+APL_DOCUMENT_LINKS = os.environ.get('APL_DOCUMENT_LINKS') == '1'
+
+def render_document_directive(name, token, datasources):
+    """Build a RenderDocument directive for one of the APL_DOCUMENTS templates."""
+    if APL_DOCUMENT_LINKS:
+        document = {'type': 'Link', 'src': f'doc://alexa/apl/documents/{name}'}
+    else:
+        document = APL_DOCUMENTS[name]
+    directive = {
+        'type': 'Alexa.Presentation.APL.RenderDocument',
+        'document': document,
+        'datasources': datasources
+    }
+    if token:
+        directive['token'] = token
+    return directive
+
+# === Helper Functions ===
+
+class _CleanTable(dict):
+    """
+    str.translate table for clean_recipe_content(). Non-printable characters
+    (other than newlines) map to None. Latin-1 is filled in at module load;
+    other lookups are cached as they happen.
+    """
+
+    def __init__(self, overrides):
+        super().__init__((codepoint, self._value(codepoint)) for codepoint in range(256))
+        self.update(overrides)
+
+    @staticmethod
+    def _value(codepoint):
+        char = chr(codepoint)
+        return codepoint if char.isprintable() or char == '\n' else None
+
+    def __missing__(self, codepoint):
+        value = self[codepoint] = self._value(codepoint)
+        return value
+
+
+# Non-breaking spaces become spaces and stray carriage returns become newlines
+_clean_table = _CleanTable({0xa0: ' ', ord('\r'): '\n'})
+
+def clean_recipe_content(content):
+    """Remove unnecessary characters and ensure correct line breaks."""
+    return content.replace('\r\n', '\n').translate(_clean_table).strip()
+
+def iter_drive_files(query, fields='id, name'):
+    """
+    Yield every file matching a Drive query, ordered by name.
+    Pages are requested at the maximum size and followed through nextPageToken,
+    so only one page is held in memory at a time.
+    """
+    query_params = {
+        'q': query,
+        'key': tenant_api_key(),
+        'pageSize': DRIVE_PAGE_SIZE,
+        'orderBy': 'name',
+        'fields': f'nextPageToken, files({fields})'
+    }
+    while True:
+        query_string = urllib.parse.urlencode(query_params)
+        query_url = f'{DRIVE_API_BASE}/drive/v3/files?{query_string}'
+        logger.debug("Fetching files with query: %s", query)
+
+        with stage('drive_fetch'):
+            data = http_get_json(query_url)
+        log_payload("Files API Response: %s", lambda: data)
+
+        yield from data.get('files', [])
+
+        page_token = data.get('nextPageToken')
+        if not page_token:
+            return
+        query_params['pageToken'] = page_token
+
+def _parent_query_batches(parent_ids):
+    """Yield "'a' in parents or 'b' in parents ..." clauses of at most DRIVE_QUERY_MAX_LENGTH characters."""
+    batch = []
+    length = 0
+    for parent_id in parent_ids:
+        clause = f"'{parent_id}' in parents"
+        if batch and length + len(clause) > DRIVE_QUERY_MAX_LENGTH:
+            yield ' or '.join(batch)
+            batch, length = [], 0
+        batch.append(clause)
+        length += len(clause) + len(' or ')
+    if batch:
+        yield ' or '.join(batch)
+
+def iter_children(parent_ids, query='trashed=false'):
+    """
+    Yield (parent_id, file) for the children of any of parent_ids that match
+    query, with TREE_FIELDS. Each parent's children come out ordered by name.
+    """
+    parent_set = set(parent_ids)
+    for batch in _parent_query_batches(parent_ids):
+        for file in iter_drive_files(f'({batch}) and {query}', fields=TREE_FIELDS):
+            for parent_id in file.get('parents', []):
+                if parent_id in parent_set:
+                    yield parent_id, file
+
+def list_categories():
+    """Query Drive for the subfolders (categories) of the tenant's root folder."""
+    folders = [
+        {'id': file['id'], 'name': file['name']}
+        for _, file in iter_children([current_tenant()['rootFolderId']], f"mimeType='{FOLDER_MIME_TYPE}' and trashed=false")
+    ]
+    item_kinds.update((folder['id'], 'folder') for folder in folders)
+    return folders
+
+# One tree refresh at a time per tenant
+_category_refresh_locks = {}
+
+def refresh_category_listings(folders, wait=False):
+    """
+    List the recipes in every category with batched queries and cache each
+    listing. A refresh that is already running is skipped, or with wait,
+    waited for (until the invocation's deadline).
+    """
+    refresh_lock = _category_refresh_locks.setdefault(current_tenant()['id'], threading.Lock())
+    if not wait:
+        if not refresh_lock.acquire(blocking=False):
+            return
+    elif not refresh_lock.acquire(timeout=max(0, time_left() or HTTP_TIMEOUT_SECONDS)):
+        return
+    try:
+        if wait and all(listing_cache.contains(tenant_key('recipes', folder['id'])) for folder in folders):
+            return  # The refresh we waited for covered them
+        listings = {folder['id']: [] for folder in folders}
+        for parent_id, file in iter_children(list(listings), f"mimeType!='{FOLDER_MIME_TYPE}' and trashed=false"):
+            listings[parent_id].append({'id': file['id'], 'name': file['name']})
+            item_kinds[file['id']] = 'recipe'
+        for folder_id, recipes in listings.items():
+            listing_cache.set(tenant_key('recipes', folder_id), recipes)
+            index_titles(folder_id, recipes)
+        # Every category was listed, so indexed recipes that aren't in any of
+        # them (including ones gone before this container started) are gone
+        index = get_search_index()
+        if index.retain({recipe['id'] for recipes in listings.values() for recipe in recipes}):
+            schedule_search_index_save(index)
+    except Exception as e:
+        logger.error(f"Error refreshing category listings: {e}")
+    finally:
+        refresh_lock.release()
+
+def load_tree():
+    """
+    Load the category list, then refresh every category's recipes on a
+    background thread, so the whole tree is refreshed in about two round
+    trips without making the category list wait for it.
+    """
+    folders = list_categories()
+    threading.Thread(target=in_tenant(refresh_category_listings), args=(folders,), daemon=True).start()
+    return folders
+
+def fetch_subfolders():
+    """Fetch subfolder (category) details from the tenant's root folder, sorted by name."""
+    get_snapshot()
+    try:
+        # Loading (or refreshing) the category list refreshes every category's recipes too
+        return listing_cache.get_or_load(tenant_key('subfolders', current_tenant()['rootFolderId']), load_tree)
+    except Exception as e:
+        logger.error("Error fetching subfolders: %s", e)
+        return []
+
+def _list_recipes_in_category(folder_id):
+    """Query Drive for the recipe documents in a category folder."""
+    logger.debug("Fetching recipes with Folder ID: %s", folder_id)
+    recipes = list(iter_drive_files(
+        f"'{folder_id}' in parents and mimeType!='{FOLDER_MIME_TYPE}' and trashed=false"
+    ))
+    item_kinds.update((recipe['id'], 'recipe') for recipe in recipes)
+    index_titles(folder_id, recipes)
+    return recipes
+
+def fetch_recipes_in_category(folder_id):
+    """Fetch recipes from the selected category folder, sorted by name."""
+    get_snapshot()
+    try:
+        return listing_cache.get_or_load(
+            tenant_key('recipes', folder_id),
+            lambda: _list_recipes_in_category(folder_id)
+        )
+    except Exception as e:
+        logger.error("Error fetching recipes: %s", e)
+        return []
+
+def _get_file_metadata(file_id):
+    """Query Drive for the metadata of a single file."""
+    query_url = f'{DRIVE_API_BASE}/drive/v3/files/{file_id}?fields=id,name,mimeType,modifiedTime&key={tenant_api_key()}'
+    logger.debug("Fetching metadata for file ID %s", file_id)
+    with stage('drive_fetch'):
+        return http_get_json(query_url)
+
+def fetch_file_metadata(file_id):
+    """Fetch id, name, mimeType and modifiedTime for a file, cached briefly."""
+    return listing_cache.get_or_load(
+        tenant_key('file', file_id),
+        lambda: _get_file_metadata(file_id),
+        ttl=CONTENT_REVALIDATE_SECONDS
+    )
+
+def export_document_text(file_id):
+    """Export a Google Doc as plain text and clean it."""
+    download_url = f'{DRIVE_API_BASE}/drive/v3/files/{file_id}/export?mimeType=text/plain&key={tenant_api_key()}'
+    logger.debug("Fetching file content for ID %s", file_id)
+    with stage('drive_fetch'):
+        _, data = http_request(download_url)
+    with stage('clean'):
+        return clean_recipe_content(data.decode('utf-8'))
+
+def fetch_recipe_content(file_id):
+    """
+    Return (content, modified_time, stale) for a Google Docs file.
+    stale is True when Drive didn't answer in time and an older cached copy is
+    returned instead; a fresh copy is then fetched in the background.
+    modified_time is None when the recipe could not be fetched; content is then
+    an error message to display instead.
+    """
+    # Revalidate against modifiedTime so an unchanged document is never exported again
+    try:
+        metadata = fetch_file_metadata(file_id)
+    except Exception as e:
+        logger.error(f"Error fetching metadata for ID {file_id}: {e}")
+        metadata = {}
+    modified_time = metadata.get('modifiedTime')
+
+    cache_key = tenant_key(file_id)
+    if modified_time:
+        cached_content = content_cache.get(cache_key, modified_time)
+        if cached_content is not None:
+            logger.debug("Recipe content for ID %s served from cache.", file_id)
+            index_recipe(file_id, metadata.get('name'), modified_time, cached_content)
+            return cached_content, modified_time, False
+
+    def export():
+        clean_content = export_document_text(file_id)
+        if modified_time:
+            content_cache.put(cache_key, modified_time, clean_content)
+            index_recipe(file_id, metadata.get('name'), modified_time, clean_content)
+        return clean_content
+
+    try:
+        return export_flights.do(tenant_key(file_id, modified_time), export), modified_time, False
+    except OSError as e:
+        fallback = content_cache.latest(cache_key)
+        if fallback is None:
+            logger.error(f"Error fetching file content for ID {file_id}: {e}")
+            return "Sorry, Google Drive is taking too long to answer. Please try again.", None, False
+        logger.warning(f"Serving cached copy of {file_id} after: {e}")
+        count('stale_fallbacks')
+        schedule_refresh(file_id)
+        return fallback[1], fallback[0], True
+    except HttpError as e:
+        logger.error(f"HTTPError fetching file ID {file_id}: {e.reason}")
+        return "Sorry, I couldn't fetch the content of this recipe. Please try again later.", None, False
+    except Exception as e:
+        logger.error(f"Error fetching file content for ID {file_id}: {e}")
+        return "An error occurred while fetching the recipe content.", None, False
+
+def download_file_content(file_id):
+    """Download the content of a Google Docs file."""
+    return fetch_recipe_content(file_id)[0]
+
+def is_folder(file_id):
+    """Check if the given ID belongs to a folder."""
+    kind = item_kinds.get(file_id)
+    if kind:
+        return kind == 'folder'
+    try:
+        logger.debug("Checking if file ID %s is a folder...", file_id)
+        # Shares the metadata cache with download_file_content's revalidation
+        mime_type = fetch_file_metadata(file_id).get('mimeType')
+        logger.debug("Mime type for ID %s: %s", file_id, mime_type)
+
+        # Validate mime_type before returning
+        if mime_type == FOLDER_MIME_TYPE:
+            item_kinds[file_id] = 'folder'
+            return True
+        item_kinds[file_id] = 'recipe'
+        return False
+    except Exception as e:
+        logger.error(f"Error checking if ID {file_id} is a folder: {e}")
+        return False
+
+def display_categories():
+    folders = fetch_subfolders()
+
+    if not folders:
+        return {
+            'version': '1.0',
+            'response': {
+                'directives': [],
+                'shouldEndSession': True
+            }
+        }
+
+    # No folder prefetch here: loading the category list already refreshes
+    # every category's recipes with batched queries (see load_tree)
+
+    with stage('apl_build'):
+        category_list = {'items': [{'id': folder['id'], 'name': folder['name']} for folder in folders]}
+        return {
+            'version': '1.0',
+            'response': {
+                'directives': [
+                    render_document_directive('categoryList', None, {'categoryList': category_list})
+                ],
+                'shouldEndSession': False
+            }
         }
+
+def build_recipe_list_window(folder_id, recipes, start_index, size):
+    """Build a dynamicIndexList window of up to size recipes starting at start_index."""
+    start_index = max(0, min(start_index, len(recipes)))
+    window = recipes[start_index:start_index + min(size, RECIPE_LIST_WINDOW)]
+    return {
+        'listId': f'recipes:{folder_id}',
+        'startIndex': start_index,
+        'minimumInclusiveIndex': 0,
+        'maximumExclusiveIndex': len(recipes),
+        'items': [{'id': recipe['id'], 'name': recipe['name']} for recipe in window]
     }
 
 def display_recipes_in_category(folder_id):
     """Build an APL document to display recipes in a selected category."""
-    sorted_file_names, file_ids = fetch_recipes_in_category(folder_id)
+    recipes = fetch_recipes_in_category(folder_id)
 
-    if not sorted_file_names:
+    if not recipes:
         return {
             'version': '1.0',
             'response': {
@@ -198,138 +1757,430 @@ def display_recipes_in_category(folder_id):
             }
         }
 
-    document = {
-        'type': 'APL',
-        'version': '2024.2',
-        'settings': {
-            'idleTimeout': 3600000,  # Keep the screen active
-            'handleKeyEvents': False  # Prevent implicit voice input
-        },
-        'mainTemplate': {
-            'parameters': [],
-            'items': [
-                {
-                    'type': 'Container',
-                    'width': '100%',
-                    'height': '100%',
-                    'items': [
-                        {
-                            'type': 'ScrollView',
-                            'width': '100%',
-                            'height': '100%',
-                            'item': {
-                                'type': 'Sequence',
-                                'scrollDirection': 'vertical',
-                                'width': '100%',
-                                'height': '100%',
-                                'items': [
-                                    {
-                                        'type': 'TouchWrapper',
-                                        'onPress': {
-                                            'type': 'SendEvent',
-                                            'arguments': [file_ids[file_name]]
-                                        },
-                                        'item': {
-                                            'type': 'Text',
-                                            'text': file_name,
-                                            'style': 'textStylePrimary1',
-                                            'paddingTop': '10dp',
-                                            'paddingBottom': '10dp',
-                                            'paddingLeft': '20dp',
-                                            'paddingRight': '20dp',
-                                            'maxLines': 1
-                                        }
-                                    } for file_name in sorted_file_names
-                                ]
-                            }
-                        }
-                    ]
-                }
-            ]
-        }
-    }
+    schedule_prefetch(recipes)
+    with stage('apl_build'):
+        recipe_list = build_recipe_list_window(folder_id, recipes, 0, RECIPE_LIST_WINDOW)
+        recipe_list['type'] = 'dynamicIndexList'
 
     # Response without outputSpeech or reprompt
     return {
         'version': '1.0',
         'response': {
             'directives': [
-                {
-                    'type': 'Alexa.Presentation.APL.RenderDocument',
-                    'document': document
-                }
+                render_document_directive('recipeList', RECIPE_LIST_TOKEN, {'recipeList': recipe_list})
             ],
             'shouldEndSession': False  # Keep session open for touch interactions
         }
     }
 
-def display_recipe_content(recipe_content, recipe_name, session_attributes):
-    """Display a recipe and save it to session attributes."""
-    session_attributes['last_recipe_content'] = recipe_content
-    session_attributes['last_recipe_name'] = recipe_name
+def handle_search_recipes(event, session_attributes):
+    """Answer a SearchRecipeIntent from the local full-text index."""
+    slots = event['request'].get('intent', {}).get('slots', {})
+    query = slots.get('query', {}).get('value')
+    if not query:
+        return build_response("What would you like to search for?", False, session_attributes)
 
-    document = {
-        'type': 'APL',
-        'version': '2024.2',
-        'settings': {'idleTimeout': 3600000},
-        'mainTemplate': {
-            'parameters': [],
-            'items': [
+    # The snapshot's recipe text, if it has any, is indexed when it is loaded
+    get_snapshot()
+    index = get_search_index()
+    titles = get_title_index()
+    if not len(titles):
+        # Nothing listed yet in this container: start listing the tree
+        fetch_subfolders()
+    unindexed = [file_id for file_id in titles.file_ids() if file_id not in index.docs]
+    if unindexed:
+        schedule_search_crawl(unindexed)
+
+    results = index.search(query, limit=SEARCH_RESULT_LIMIT)
+    logger.info(f"Search for '{query}' found {len(results)} recipes, {len(unindexed)} not indexed yet")
+    if not len(index):
+        partial = " I'm still reading your recipes, so try again in a moment."
+    elif not len(titles) or unindexed:
+        searched = 'the one recipe' if len(index) == 1 else f'the {len(index)} recipes'
+        partial = f" I've only searched {searched} I've read so far, so try again in a moment for more."
+    else:
+        partial = ''
+    if not results:
+        return build_response(f"I couldn't find any recipes matching {query}.{partial}", False, session_attributes)
+
+    found = 'one recipe' if len(results) == 1 else f'{len(results)} recipes'
+    return display_recipe_results(
+        results,
+        f"I found {found} matching {query}. The best match is {results[0]['name']}.{partial}",
+        session_attributes
+    )
+
+def display_recipe_results(results, speech_text, session_attributes):
+    """Show search or title-match results as a touchable recipe list."""
+    item_kinds.update((result['id'], 'recipe') for result in results)
+    recipe_list = {
+        'type': 'dynamicIndexList',
+        'listId': 'search',
+        'startIndex': 0,
+        'minimumInclusiveIndex': 0,
+        'maximumExclusiveIndex': len(results),
+        'items': [{'id': result['id'], 'name': result['name']} for result in results]
+    }
+
+    return {
+        'version': '1.0',
+        'sessionAttributes': session_attributes,
+        'response': {
+            'outputSpeech': {'type': 'PlainText', 'text': speech_text},
+            'directives': [
+                render_document_directive('recipeList', RECIPE_LIST_TOKEN, {'recipeList': recipe_list})
+            ],
+            'shouldEndSession': False
+        }
+    }
+
+def handle_open_recipe(event, session_attributes):
+    """Open a recipe by its spoken title, without going through the category lists."""
+    slots = event['request'].get('intent', {}).get('slots', {})
+    title = slots.get('title', {}).get('value')
+    if not title:
+        return build_response("Which recipe would you like to open?", False, session_attributes)
+
+    index = get_title_index()
+    if not len(index):
+        # Nothing listed yet in this container: list the whole tree first
+        refresh_category_listings(fetch_subfolders(), wait=True)
+    with stage('title_match'):
+        candidates = index.match(title, limit=SEARCH_RESULT_LIMIT)
+    matches = [m for m in candidates if m['score'] >= TITLE_MATCH_MIN_SCORE]
+    logger.info(f"Title '{title}' matched {len(matches)} recipes")
+    if not matches:
+        return build_response(f"I couldn't find a recipe called {title}.", False, session_attributes)
+
+    best = matches[0]
+    complete = [m for m in candidates if m['complete']]
+    if not best['exact'] and len(complete) > 1:
+        return display_recipe_results(complete, f"I found {len(complete)} recipes with {title} in the name. Which one would you like?", session_attributes)
+
+    close = [m for m in matches if m['score'] >= best['score'] - TITLE_MATCH_MARGIN]
+    if len({m['name'].lower() for m in close}) > 1:
+        names = ' or '.join(m['name'] for m in close[:2])
+        return display_recipe_results(matches, f"Did you mean {names}?", session_attributes)
+
+    usage_counts[best['id']] += 1
+    item_kinds[best['id']] = 'recipe'
+    recipe_content, modified_time, stale = fetch_recipe_content(best['id'])
+    if recipe_content:
+        return display_recipe_content(
+            recipe_content,
+            best['name'],
+            session_attributes,
+            file_id=best['id'],
+            modified_time=modified_time,
+            stale=stale
+        )
+    return build_response("Sorry, I couldn't load this recipe.", False, session_attributes)
+
+def handle_load_index_list_data(event):
+    """Send the next window of a recipe list when the device scrolls into it."""
+    request = event['request']
+    list_id = request.get('listId', '')
+    if not list_id.startswith('recipes:'):
+        logger.error(f"Unknown list ID in LoadIndexListData: {list_id}")
+        return handle_fallback()
+
+    folder_id = list_id[len('recipes:'):]
+    recipes = fetch_recipes_in_category(folder_id)
+    window = build_recipe_list_window(
+        folder_id,
+        recipes,
+        request.get('startIndex', 0),
+        request.get('count', RECIPE_LIST_WINDOW)
+    )
+
+    return {
+        'version': '1.0',
+        'response': {
+            'directives': [
                 {
-                    'type': 'ScrollView',
-                    'id': 'recipeScrollView',
-                    'width': '100%',
-                    'height': '100%',
-                    'item': {
-                        'type': 'Text',
-                        'text': recipe_content.replace('\n', '<br>'),
-                        'style': 'textStylePrimary1',
-                        'paddingLeft': '20dp',
-                        'paddingRight': '20dp',
-                        'paddingTop': '20dp',
-                        'paddingBottom': '20dp',
-                        'maxLines': 0
-                    }
+                    'type': 'Alexa.Presentation.APL.SendIndexListData',
+                    'token': request.get('token', RECIPE_LIST_TOKEN),
+                    'correlationToken': request.get('correlationToken'),
+                    **window
                 }
-            ]
+            ],
+            'shouldEndSession': False
         }
     }
 
+# === Recipe Layout ===
+
+# Section headings as they appear in recipe docs, mapped to section kinds
+SECTION_KINDS = {
+    'ingredient': 'ingredients',
+    'ingredients': 'ingredients',
+    'directions': 'steps',
+    'instructions': 'steps',
+    'method': 'steps',
+    'preparation': 'steps',
+    'step': 'steps',
+    'steps': 'steps',
+    'note': 'notes',
+    'notes': 'notes',
+    'tips': 'notes'
+}
+SECTION_HEADING_PATTERN = re.compile(r'^(' + '|'.join(SECTION_KINDS) + r')\s*:?$', re.IGNORECASE)
+STEP_NUMBER_PATTERN = re.compile(r'^(?:step\s*)?\d+\s*[.):-]\s*', re.IGNORECASE)
+
+def parse_recipe_sections(content):
+    """Split cleaned recipe text into intro, ingredients, steps and notes sections."""
+    sections = [{'kind': 'intro', 'title': None, 'lines': []}]
+    for line in content.split('\n'):
+        line = line.strip()
+        if not line:
+            continue
+        match = SECTION_HEADING_PATTERN.match(line)
+        if match:
+            sections.append({'kind': SECTION_KINDS[match.group(1).lower()], 'title': line.rstrip(':'), 'lines': []})
+        else:
+            sections[-1]['lines'].append(line)
+    return [section for section in sections if section['title'] or section['lines']]
+
+def build_recipe_layout(content):
+    """Flatten a recipe into APL rows, recording the row each section and step starts at."""
+    rows = []
+    sections = {}
+    steps = []
+    for section in parse_recipe_sections(content):
+        sections.setdefault(section['kind'], len(rows))
+        if section['title']:
+            rows.append({'type': 'heading', 'text': section['title']})
+        for line in section['lines']:
+            if section['kind'] == 'steps':
+                steps.append(len(rows))
+                rows.append({'type': 'step', 'text': f"{len(steps)}. {STEP_NUMBER_PATTERN.sub('', line)}"})
+            else:
+                rows.append({'type': 'line', 'text': line})
+    return {'rows': rows, 'sections': sections, 'steps': steps}
+
+def get_recipe_layout(content, file_id=None, modified_time=None):
+    """
+    Return the cached layout for this version of a recipe, building it on first use.
+    modified_time must be the version content was read at (as returned by
+    fetch_recipe_content); without one, as for an error message, nothing is cached.
+    """
+    if not file_id or not modified_time:
+        return build_recipe_layout(content)
+    return recipe_layout_cache.get_or_load(tenant_key(file_id, modified_time), lambda: build_recipe_layout(content))
+
+# === Session State ===
+# The session only carries a reference to the recipe on screen; its text is
+# looked up in the content cache (or re-exported from Drive) when needed.
+
+def pack_session_text(text):
+    """Compress text that has to travel in the session when it is large."""
+    if len(text) < SESSION_COMPRESS_MIN_BYTES:
+        return {'text': text}
+    packed = base64.b64encode(zlib.compress(text.encode('utf-8'))).decode('ascii')
+    return {'zlib': packed}
+
+def unpack_session_text(packed):
+    if 'zlib' in packed:
+        return zlib.decompress(base64.b64decode(packed['zlib'])).decode('utf-8')
+    return packed.get('text')
+
+def save_recipe_session(session_attributes, file_id, name, modified_time, content, scroll=0, index=0, stale=False):
+    """Record the recipe on screen in the session attributes."""
+    session_attributes['recipe'] = {
+        'id': file_id,
+        'name': name,
+        'modifiedTime': modified_time,
+        'index': index,
+        'scroll': scroll
+    }
+    if stale:
+        # An older cached copy is on screen; the next re-render fetches it again
+        session_attributes['recipe']['stale'] = True
+    if RECIPE_STORE == 'session' or not file_id:
+        # A recipe without a file id (from an older session) can't be looked up again
+        session_attributes['recipe_text'] = pack_session_text(content)
+    else:
+        session_attributes.pop('recipe_text', None)
+    # Sessions started by older versions carried the full text
+    session_attributes.pop('last_recipe_content', None)
+    session_attributes.pop('last_recipe_name', None)
+
+def load_recipe_session(session_attributes, refresh_stale=False):
+    """
+    Return (recipe_ref, content) for the recipe in the session, or (None, None).
+    content is None when the recipe couldn't be loaded. When the text has to be
+    fetched, the reference is updated to the version returned. With
+    refresh_stale, a recipe that was shown from a stale copy is always fetched again.
+    """
+    recipe = session_attributes.get('recipe')
+    if not recipe:
+        if 'last_recipe_content' in session_attributes:
+            # Move a session from an older version over to a recipe reference
+            content = session_attributes['last_recipe_content']
+            save_recipe_session(session_attributes, None, session_attributes.get('last_recipe_name'), None, content)
+            return session_attributes['recipe'], content
+        return None, None
+
+    if 'recipe_text' in session_attributes:
+        return recipe, unpack_session_text(session_attributes['recipe_text'])
+
+    if recipe.get('modifiedTime') and not (refresh_stale and recipe.get('stale')):
+        content = content_cache.get(tenant_key(recipe['id']), recipe['modifiedTime'])
+        if content is not None:
+            return recipe, content
+
+    content, modified_time, stale = fetch_recipe_content(recipe['id'])
+    if modified_time is None:
+        # content is an error message, not this recipe's text
+        return recipe, None
+    recipe['modifiedTime'] = modified_time
+    if stale:
+        recipe['stale'] = True
+    else:
+        recipe.pop('stale', None)
+    return recipe, content
+
+def display_recipe_content(recipe_content, recipe_name, session_attributes, file_id=None, modified_time=None, scroll=0, index=0, stale=False):
+    """Display a recipe and save a reference to it in the session attributes."""
+    save_recipe_session(session_attributes, file_id, recipe_name, modified_time, recipe_content, scroll, index, stale)
+
+    with stage('apl_build'):
+        layout = get_recipe_layout(recipe_content, file_id, modified_time)
+    recipe = {'rows': layout['rows']}
+
+    commands = [{"type": "Focus", "componentId": RECIPE_COMPONENT_ID}]
+    # Restore the position the user had jumped or scrolled to
+    if index:
+        commands.append({"type": "ScrollToIndex", "componentId": RECIPE_COMPONENT_ID, "index": index, "align": "first"})
+    if scroll:
+        commands.append({"type": "Scroll", "componentId": RECIPE_COMPONENT_ID, "distance": SCROLL_FRACTION * scroll})
+
     return {
         'version': '1.0',
         'sessionAttributes': session_attributes,
         'response': {
             'directives': [
+                render_document_directive('recipeContent', 'recipeContentToken', {'recipe': recipe}),
                 {
-                    "type": "Alexa.Presentation.APL.RenderDocument",
+                    "type": "Alexa.Presentation.APL.ExecuteCommands",
                     "token": "recipeContentToken",
-                    "document": document
-                },
+                    "commands": commands
+                }
+            ],
+            'shouldEndSession': False
+        }
+    }
+
+def display_recipe_from_session(session_attributes):
+    """Re-render the recipe referenced by the session, or return None if there is none."""
+    recipe, content = load_recipe_session(session_attributes, refresh_stale=True)
+    if not recipe:
+        return None
+    if content is None:
+        return build_response("Sorry, I couldn't load this recipe. Please try again.", False, session_attributes)
+    return display_recipe_content(
+        content,
+        recipe['name'],
+        session_attributes,
+        file_id=recipe['id'],
+        modified_time=recipe['modifiedTime'],
+        scroll=recipe.get('scroll', 0),
+        index=recipe.get('index', 0),
+        stale=recipe.get('stale', False)
+    )
+
+def scroll_recipe_to_row(session_attributes, index, speech_text=None):
+    """Move the recipe on screen to a row without re-rendering it."""
+    recipe = session_attributes['recipe']
+    recipe['index'] = index
+    recipe['scroll'] = 0
+
+    response = {
+        'version': '1.0',
+        'sessionAttributes': session_attributes,
+        'response': {
+            'directives': [
                 {
                     "type": "Alexa.Presentation.APL.ExecuteCommands",
                     "token": "recipeContentToken",
-                    "commands": [{"type": "Focus", "componentId": "recipeScrollView"}]
+                    "commands": [
+                        {"type": "ScrollToIndex", "componentId": RECIPE_COMPONENT_ID, "index": index, "align": "first"}
+                    ]
                 }
             ],
             'shouldEndSession': False
         }
     }
+    if speech_text:
+        response['response']['outputSpeech'] = {'type': 'PlainText', 'text': speech_text}
+    return response
 
+def current_recipe_layout(session_attributes):
+    """
+    Return (recipe_ref, layout) for the recipe on screen. recipe_ref is None
+    if no recipe is open, and layout is None if it couldn't be loaded.
+    """
+    recipe, content = load_recipe_session(session_attributes)
+    if content is None:
+        return recipe, None
+    return recipe, get_recipe_layout(content, recipe['id'], recipe['modifiedTime'])
+
+def handle_go_to_step(event, session_attributes):
+    """Jump to a numbered step of the recipe on screen."""
+    slots = event['request'].get('intent', {}).get('slots', {})
+    try:
+        number = int(slots.get('number', {}).get('value'))
+    except (TypeError, ValueError):
+        return build_response("Which step would you like to see?", False, session_attributes)
+
+    recipe, layout = current_recipe_layout(session_attributes)
+    if not recipe:
+        return build_response("Open a recipe first, then ask for a step.", False, session_attributes)
+    if not layout:
+        return build_response("Sorry, I couldn't load this recipe. Please try again.", False, session_attributes)
+    steps = layout['steps']
+    if not 1 <= number <= len(steps):
+        if not steps:
+            return build_response("I couldn't find numbered steps in this recipe.", False, session_attributes)
+        return build_response(f"This recipe has {len(steps)} steps.", False, session_attributes)
+    return scroll_recipe_to_row(session_attributes, steps[number - 1])
+
+def handle_show_section(event, session_attributes):
+    """Jump to the ingredients, steps or notes of the recipe on screen."""
+    slots = event['request'].get('intent', {}).get('slots', {})
+    section_name = (slots.get('section', {}).get('value') or '').strip().lower()
+    kind = SECTION_KINDS.get(section_name, SECTION_KINDS.get(section_name.rstrip('s')))
+
+    recipe, layout = current_recipe_layout(session_attributes)
+    if not recipe:
+        return build_response("Open a recipe first.", False, session_attributes)
+    if not layout:
+        return build_response("Sorry, I couldn't load this recipe. Please try again.", False, session_attributes)
+    if kind not in layout['sections']:
+        section = f'the {section_name}' if section_name else 'a matching'
+        return build_response(f"I couldn't find {section} section in this recipe.", False, session_attributes)
+    return scroll_recipe_to_row(session_attributes, layout['sections'][kind])
 
 def handle_scroll(event, direction, session_attributes=None):
     """Handle scrolling actions."""
     try:
         # Scroll fraction to determine the distance to scroll
-        scroll_fraction = 0.75 * direction
+        scroll_fraction = SCROLL_FRACTION * direction
+
+        # Track the position so a re-rendered recipe opens where the user left it
+        recipe = (session_attributes or {}).get('recipe')
+        if recipe:
+            recipe['scroll'] = max(0, recipe.get('scroll', 0) + direction)
 
         # APL commands for scrolling
         commands = [
-            {"type": "Scroll", "componentId": "recipeScrollView", "distance": scroll_fraction}
+            {"type": "Scroll", "componentId": RECIPE_COMPONENT_ID, "distance": scroll_fraction}
         ]
 
         # Return the directive for scrolling
         return {
             'version': '1.0',
+            'sessionAttributes': session_attributes or {},
             'response': {
                 'directives': [
                     {
@@ -345,12 +2196,14 @@ def handle_scroll(event, direction, session_attributes=None):
         logger.error(f"Error in handle_scroll: {e}")
         return build_response("An error occurred while scrolling. Please try again.", False)
 
+DURATION_PATTERN = re.compile(r'^PT(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?$')
+
 def parse_duration_to_seconds(duration):
     """
     Converts an ISO 8601 duration string to seconds.
     Example: 'PT5M' -> 300 seconds.
     """
-    match = re.match(r'^PT(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?$', duration)
+    match = DURATION_PATTERN.match(duration)
     if not match:
         raise ValueError("Invalid ISO 8601 duration format")
 
@@ -383,7 +2236,31 @@ def build_response(speech_text, should_end_session, session_attributes=None):
         response['sessionAttributes'] = session_attributes
     return response
 
+def timer_api_credentials(event):
+    """Return (api_endpoint, api_access_token) for the Alexa Timer API."""
+    system = event.get('context', {}).get('System', {})
+    api_endpoint = system.get('apiEndpoint')
+    api_access_token = system.get('apiAccessToken')
+    if not api_endpoint or not api_access_token:
+        raise ValueError("API endpoint or access token is missing.")
+    return api_endpoint, api_access_token
+
+def describe_duration(seconds):
+    """Spoken form of a duration, e.g. 5400 -> '1 hour 30 minutes'."""
+    parts = []
+    for unit, size in (('hour', 3600), ('minute', 60), ('second', 1)):
+        amount, seconds = divmod(seconds, size)
+        if amount:
+            parts.append(f"{amount} {unit}{'s' if amount != 1 else ''}")
+    return ' '.join(parts) or '0 seconds'
+
+def format_iso_duration(seconds):
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return 'PT' + ''.join(f'{value}{unit}' for value, unit in ((hours, 'H'), (minutes, 'M'), (seconds, 'S')) if value)
+
 def handle_set_timer(event, session_attributes, context):
+    """Set one timer and confirm it by voice, leaving the recipe on screen as it is."""
     try:
         # Extract the intent request
         intent_request = event.get('request', {})
@@ -394,55 +2271,31 @@ def handle_set_timer(event, session_attributes, context):
         duration = slots.get('duration', {}).get('value')
         if not duration:
             raise ValueError("Duration slot is missing or invalid.")
+        seconds = parse_duration_to_seconds(duration)
 
-        # Use a default label or customize it
-        label = "Recipe Timer"  # You can make this dynamic if needed
+        # Use the open recipe's name as the label when there is one
+        recipe = session_attributes.get('recipe') or {}
+        label = recipe.get('name') or "Recipe Timer"
 
-        # Get API endpoint and access token
-        api_endpoint = event.get('context', {}).get('System', {}).get('apiEndpoint')
-        api_access_token = event.get('context', {}).get('System', {}).get('apiAccessToken')
-        if not api_endpoint or not api_access_token:
-            raise ValueError("API endpoint or access token is missing.")
+        api_endpoint, api_access_token = timer_api_credentials(event)
 
         # Call the Alexa Timer API
         timer_response = create_or_set_timer(api_endpoint, api_access_token, duration, label)
         if 'error' in timer_response:
             logger.error(f"Timer API Error: {timer_response}")
-            return build_response("There was an issue setting the timer. Please try again.", False)
-
-        # Retain the currently viewed recipe
-        last_recipe_content = session_attributes.get('last_recipe_content')
-        last_recipe_name = session_attributes.get('last_recipe_name')
-
-        if last_recipe_content and last_recipe_name:
-            # Return a response that retains the recipe on the screen
-            response = display_recipe_content(
-                last_recipe_content,
-                last_recipe_name,
-                session_attributes
-            )
-            # Add a spoken confirmation that the timer was set
-            response['response']['outputSpeech'] = {
-                'type': 'PlainText',
-                'text': f"Timer set for {duration}. You can continue viewing your recipe."
-            }
-            return response
-        else:
-            # Fallback if no recipe is found in the session
-            return build_response(f"Timer set for {duration}.", False)
+            return build_response("There was an issue setting the timer. Please try again.", False, session_attributes)
+
+        return build_response(f"Timer set for {describe_duration(seconds)}.", False, session_attributes)
 
     except Exception as e:
         logger.error(f"Error in handle_set_timer: {str(e)}")
-        return build_response("An unexpected error occurred. Please try again later.", False)
+        return build_response("An unexpected error occurred. Please try again later.", False, session_attributes)
 
-def create_or_set_timer(api_endpoint, api_access_token, duration, label):
+def create_or_set_timer(api_endpoint, api_access_token, duration, label, timeout=TIMER_API_TIMEOUT_SECONDS):
     """
     Create or set a timer using the Alexa Timer API.
-    Uses urllib.request instead of requests.
+    Uses the shared HTTP client instead of requests.
     """
-    import json
-    import urllib.request
-
     headers = {
         "Authorization": f"Bearer {api_access_token}",
         "Content-Type": "application/json"
@@ -475,58 +2328,223 @@ def create_or_set_timer(api_endpoint, api_access_token, duration, label):
     url = f"{api_endpoint}/v1/alerts/timers"
     data = json.dumps(timer_payload).encode('utf-8')
 
-    req = urllib.request.Request(url, data=data, headers=headers, method='POST')
-
     try:
-        with urllib.request.urlopen(req) as response:
-            response_data = response.read().decode('utf-8')
-            return json.loads(response_data)
-    except urllib.error.HTTPError as e:
-        logger.error(f"HTTPError while calling Alexa Timer API: {e.reason}, {e.read().decode()}")
+        _, response_data = http_request(url, method='POST', headers=headers, body=data, timeout=timeout)
+        return json.loads(response_data.decode('utf-8'))
+    except HttpError as e:
+        logger.error(f"HTTPError while calling Alexa Timer API: {e.reason}, {e.body.decode(errors='replace')}")
         return {"error": f"HTTPError: {e.reason}"}
-    except urllib.error.URLError as e:
-        logger.error(f"URLError while calling Alexa Timer API: {e.reason}")
-        return {"error": f"URLError: {e.reason}"}
+    except OSError as e:
+        logger.error(f"URLError while calling Alexa Timer API: {e}")
+        return {"error": f"URLError: {e}"}
     except Exception as e:
         logger.error(f"Unexpected error while calling Alexa Timer API: {str(e)}")
         return {"error": str(e)}
 
+NUMBER_WORDS = {
+    'a': 1, 'an': 1, 'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5, 'six': 6, 'seven': 7,
+    'eight': 8, 'nine': 9, 'ten': 10, 'twelve': 12, 'fifteen': 15, 'twenty': 20, 'thirty': 30,
+    'forty': 40, 'forty-five': 45, 'sixty': 60, 'ninety': 90
+}
+UNIT_SECONDS = {'h': 3600, 'm': 60, 's': 1}
+VULGAR_FRACTIONS = {'½': 1 / 2, '⅓': 1 / 3, '⅔': 2 / 3, '¼': 1 / 4, '¾': 3 / 4, '⅕': 1 / 5, '⅙': 1 / 6, '⅛': 1 / 8}
+# "25", "1.5", "1/2", "1 1/2", "1½", "½" or a number word
+TIMER_AMOUNT = (
+    r'(?:\d+\s+\d+/\d+|\d+\s*[' + ''.join(VULGAR_FRACTIONS) + r']|\d+/\d+|[' + ''.join(VULGAR_FRACTIONS) + r']'
+    r'|\d+(?:\.\d+)?|' + '|'.join(sorted(NUMBER_WORDS, key=len, reverse=True)) + r')'
+)
+# "25 minutes", "1.5 hrs", "an hour", "1 1/2 hours", "20-25 min" (the lower
+# bound is used). A number can't follow a word character, "/" or ".", so the
+# 2 of "1/2" is never read on its own.
+TIMER_DURATION_PATTERN = re.compile(
+    r'(?<![\w/.])(' + TIMER_AMOUNT + r')'
+    r'(?:\s*(?:-|–|to)\s*' + TIMER_AMOUNT + r')?\s*'
+    r'(hours?|hrs?|minutes?|mins?|seconds?|secs?)\b',
+    re.IGNORECASE
+)
+# "1 hour 30 minutes" and "1 hour and 30 minutes" are one duration
+DURATION_JOINER_PATTERN = re.compile(r'\s*(?:and\s*)?', re.IGNORECASE)
+
+def parse_timer_amount(amount):
+    """Return the value of an amount matched by TIMER_AMOUNT, e.g. 1.5 for "1 1/2"."""
+    amount = amount.lower()
+    if amount in NUMBER_WORDS:
+        return NUMBER_WORDS[amount]
+    fraction = 0
+    if amount[-1] in VULGAR_FRACTIONS:
+        fraction = VULGAR_FRACTIONS[amount[-1]]
+        amount = amount[:-1].strip()
+    elif '/' in amount:
+        whole, _, fraction_text = amount.rpartition(' ')
+        numerator, denominator = fraction_text.split('/')
+        fraction = int(numerator) / int(denominator) if int(denominator) else 0
+        amount = whole
+    return (float(amount) if amount else 0) + fraction
+
+def extract_step_durations(text):
+    """Return the durations mentioned in a line of recipe text, in seconds."""
+    durations = []
+    last_end = None
+    for match in TIMER_DURATION_PATTERN.finditer(text):
+        seconds = round(parse_timer_amount(match.group(1)) * UNIT_SECONDS[match.group(2)[0].lower()])
+        if last_end is not None and DURATION_JOINER_PATTERN.fullmatch(text, last_end, match.start()):
+            durations[-1] += seconds
+        else:
+            durations.append(seconds)
+        last_end = match.end()
+    return [seconds for seconds in durations if 0 < seconds <= TIMER_MAX_SECONDS]
+
+def extract_recipe_timers(layout):
+    """Return [{'step', 'row', 'seconds'}] for the durations in a recipe's steps."""
+    timers = []
+    for number, row_index in enumerate(layout['steps'], start=1):
+        for seconds in extract_step_durations(layout['rows'][row_index]['text']):
+            timers.append({'step': number, 'row': row_index, 'seconds': seconds})
+    return timers
+
+def create_timers(api_endpoint, api_access_token, timers, label, deadline_seconds=TIMER_BATCH_DEADLINE_SECONDS):
+    """
+    Create timers in parallel, waiting at most deadline_seconds.
+    Returns (created, failed, pending) lists of the given timer dicts. Pending
+    requests carry on in the background and may still succeed.
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait
+
+    executor = ThreadPoolExecutor(max_workers=len(timers), thread_name_prefix='timer')
+    futures = {}
+    for timer in timers:
+        # Each request runs in a copy of this invocation's context so its HTTP calls are counted
+        futures[executor.submit(
+            contextvars.copy_context().run,
+            create_or_set_timer,
+            api_endpoint,
+            api_access_token,
+            format_iso_duration(timer['seconds']),
+            f"{label} step {timer['step']}",
+            deadline_seconds
+        )] = timer
+    done, not_done = wait(futures, timeout=deadline_seconds)
+    executor.shutdown(wait=False)
+
+    created, failed, pending = [], [], []
+    for future, timer in futures.items():  # in step order
+        if future in not_done:
+            pending.append(timer)
+        elif 'error' in future.result():
+            failed.append(timer)
+        else:
+            created.append(timer)
+    return created, failed, pending
+
+def handle_set_all_timers(event, session_attributes):
+    """Create a timer for every duration in the open recipe's steps."""
+    try:
+        recipe, layout = current_recipe_layout(session_attributes)
+        if not recipe:
+            return build_response("Open a recipe first, then ask me to set its timers.", False, session_attributes)
+        if not layout:
+            return build_response("Sorry, I couldn't load this recipe. Please try again.", False, session_attributes)
+        timers = extract_recipe_timers(layout)
+        if not timers:
+            return build_response("I didn't find any cooking times in this recipe's steps.", False, session_attributes)
+        skipped = len(timers) - TIMER_BATCH_MAX
+        timers = timers[:TIMER_BATCH_MAX]
+
+        api_endpoint, api_access_token = timer_api_credentials(event)
+        with stage('timers'):
+            created, failed, pending = create_timers(
+                api_endpoint, api_access_token, timers, recipe.get('name') or 'Recipe'
+            )
+        count('timers_created', len(created))
+
+        if not created and not pending:
+            return build_response("There was an issue setting the timers. Please try again.", False, session_attributes)
+        speech = ', '.join(f"{describe_duration(t['seconds'])} for step {t['step']}" for t in created)
+        speech = f"I set {len(created)} timer{'s' if len(created) != 1 else ''}: {speech}." if created else ''
+        if pending:
+            speech += f" {len(pending)} more {'are' if len(pending) != 1 else 'is'} still being set."
+        if failed:
+            speech += f" {len(failed)} couldn't be set."
+        if skipped > 0:
+            speech += f" I only set the first {TIMER_BATCH_MAX}."
+
+        # Bring the first timed step into view without re-rendering the recipe
+        first = (created or pending)[0]
+        return scroll_recipe_to_row(session_attributes, first['row'], speech.strip())
+    except Exception as e:
+        logger.error(f"Error in handle_set_all_timers: {e}")
+        return build_response("An unexpected error occurred. Please try again later.", False, session_attributes)
+
 def handle_user_event(event, session_attributes):
     """Handle user selection of a category or recipe."""
     arguments = event['request'].get('arguments', [])
     if not arguments or not isinstance(arguments, list):
         return build_response("Sorry, I couldn't process your selection.", False)
 
+    # Arguments are [id, kind, name]; documents rendered by older versions only send the id
     selected_id = arguments[0]
-    logger.info(f"Selected ID: {selected_id}")
+    selected_kind = arguments[1] if len(arguments) > 1 else None
+    selected_name = arguments[2] if len(arguments) > 2 else selected_id
+    logger.debug("Selected ID: %s (%s)", selected_id, selected_kind)
 
-    if is_folder(selected_id):
+    if selected_kind is None:
+        selected_kind = 'folder' if is_folder(selected_id) else 'recipe'
+    usage_counts[selected_id] += 1
+
+    if selected_kind == 'folder':
         return display_recipes_in_category(selected_id)
     else:
-        recipe_content = download_file_content(selected_id)
+        recipe_content, modified_time, stale = fetch_recipe_content(selected_id)
         if recipe_content:
-            return display_recipe_content(recipe_content, selected_id, session_attributes)
+            return display_recipe_content(
+                recipe_content,
+                selected_name,
+                session_attributes,
+                file_id=selected_id,
+                modified_time=modified_time,
+                stale=stale
+            )
         return build_response("Sorry, I couldn't load this recipe.", False)
 
 def lambda_handler(event, context):
     """Main Lambda handler."""
-    logger.info("Event received: %s", json.dumps(event))
+    metrics = start_invocation(event.get('request', {}).get('type', 'Unknown'))
+    set_deadline(context)
+    response = None
+    try:
+        tenant = resolve_tenant(event)
+        if tenant is None:
+            logger.warning("Request from a device and user that aren't registered to any tenant")
+            response = build_response("This device isn't linked to a recipe library yet.", True)
+            return response
+        metrics['tenant'] = tenant['id']
+        _tenant.set(tenant)
+        response = dispatch_request(event, context)
+        return response
+    finally:
+        _deadline.set(None)
+        _tenant.set(None)
+        finish_invocation(metrics, response)
+
+def dispatch_request(event, context):
+    """Route an Alexa request to its handler."""
+    log_payload("Event received: %s", lambda: event)
     session_attributes = event.get('session', {}).get('attributes', {})
 
     if event['request']['type'] == 'LaunchRequest':
         # Check if a recipe was previously viewed
-        if 'last_recipe_content' in session_attributes and 'last_recipe_name' in session_attributes:
-            return display_recipe_content(
-                session_attributes['last_recipe_content'],
-                session_attributes['last_recipe_name'],
-                session_attributes
-            )
+        response = display_recipe_from_session(session_attributes)
+        if response:
+            return response
         # Default to displaying categories
         return display_categories()
 
     if event['request']['type'] == 'Alexa.Presentation.APL.UserEvent':
         return handle_user_event(event, session_attributes)
 
+    if event['request']['type'] == 'Alexa.Presentation.APL.LoadIndexListData':
+        return handle_load_index_list_data(event)
+
     if event['request']['type'] == 'IntentRequest':
         intent_name = event['request']['intent']['name']
 
@@ -536,7 +2554,42 @@ def lambda_handler(event, context):
             return handle_scroll(event, direction=-1, session_attributes=session_attributes)
         elif intent_name == "SetTimerIntent":
             return handle_set_timer(event, session_attributes, context)
+        elif intent_name == "SetAllTimersIntent":
+            return handle_set_all_timers(event, session_attributes)
+        elif intent_name == "GoToStepIntent":
+            return handle_go_to_step(event, session_attributes)
+        elif intent_name == "ShowSectionIntent":
+            return handle_show_section(event, session_attributes)
+        elif intent_name == "SearchRecipeIntent":
+            return handle_search_recipes(event, session_attributes)
+        elif intent_name == "OpenRecipeIntent":
+            return handle_open_recipe(event, session_attributes)
         elif intent_name == "AMAZON.FallbackIntent":
             return handle_fallback()
 
     return build_response("Sorry, I couldn't process your request. Please try again.", True)
+
+def init():
+    """
+    Container setup run once at import, during Lambda's init phase: load the
+    tenant registry and snapshot and open a connection to Drive ahead of the
+    first request.
+    """
+    global _pending_init_metrics
+    started = time.perf_counter()
+    try:
+        get_tenant_registry()
+        get_snapshot()
+        if INIT_PRECONNECT:
+            preconnect(DRIVE_API_BASE, timeout=INIT_PRECONNECT_TIMEOUT_SECONDS)
+    except Exception as e:
+        logger.error(f"Error during init: {e}")
+    finished = time.perf_counter()
+    _pending_init_metrics = {
+        'cold_start': 1,
+        'init_imports_ms': round((started - _init_started) * 1000, 3),
+        'init_ms': round((finished - _init_started) * 1000, 3)
+    }
+    logger.info(f"Init finished in {_pending_init_metrics['init_ms']} ms")
+
+init()
@@ -0,0 +1,244 @@
+"""
+Load test the self-hosted endpoint (serve.py) against fake_drive.py.
+
+    python loadtest.py                          # 20 devices for 10 seconds
+    python loadtest.py --devices 50 --duration 30 --latency-ms 80
+    python loadtest.py --tenants 8 --devices 32 --trace-memory
+
+Two phases run against one in-process server:
+  burst     every device opens the same recipe at the same moment on cold
+            caches; with request coalescing this costs one metadata check and
+            one export no matter how many devices there are
+  sustained each device loops through bench.py's navigation session; reports
+            requests per second, latency percentiles and Drive requests
+
+With --tenants, each household gets its own tree and the devices are spread
+across them, opening random recipes. The first household's library is huge
+(--huge-recipes), and the cache limits are shrunk so it overflows its quota;
+the report shows each household's hit ratios and cache use next to the
+container-wide limits.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import threading
+import time
+import tracemalloc
+
+import bench
+import fake_drive
+import lambda_function
+import serve
+
+
+class Device:
+    """One Echo Show posting skill requests over a keep-alive connection."""
+
+    def __init__(self, port):
+        self.conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+
+    def send(self, event):
+        self.conn.request('POST', '/', json.dumps(event), {'Content-Type': 'application/json'})
+        response = self.conn.getresponse()
+        body = response.read()
+        if response.status != 200:
+            raise RuntimeError(f'HTTP {response.status}: {body[:200]!r}')
+        return json.loads(body)
+
+    def close(self):
+        self.conn.close()
+
+
+def setup_tenants(drive, tenants, recipes, huge_recipes, work_dir):
+    """
+    Add one synthetic tree per household to drive and register the households
+    with the skill. Returns {tenant id: (id prefix, device id)}.
+    """
+    config = {'tenants': {}}
+    households = {}
+    for i in range(tenants):
+        tenant_id, prefix = f'household{i:02d}', f'h{i:02d}-'
+        drive.add_tree(fake_drive.synthetic_tree(huge_recipes if i == 0 else recipes, seed=i, id_prefix=prefix))
+        config['tenants'][tenant_id] = {'rootFolderId': f'{prefix}root', 'devices': [f'{prefix}device']}
+        households[tenant_id] = (prefix, f'{prefix}device')
+    path = os.path.join(work_dir, 'tenants.json')
+    os.makedirs(work_dir, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(config, f)
+    lambda_function.TENANTS_FILE = path
+    lambda_function._tenant_registry = None
+    return households
+
+
+def run_burst(port, drive, api_endpoint, devices, id_prefix='', device_id='bench-device'):
+    """Open one recipe on every device at once and return the Drive requests it cost."""
+    recipe = next(
+        file for file in drive.files.values()
+        if file['mimeType'] == fake_drive.DOCUMENT_MIME_TYPE and file['id'].startswith(id_prefix)
+    )
+    event = bench.make_event(
+        {'type': 'Alexa.Presentation.APL.UserEvent', 'arguments': [recipe['id'], 'recipe', recipe['name']]},
+        {},
+        api_endpoint,
+        device_id=device_id
+    )
+    clients = [Device(port) for _ in range(devices)]
+    barrier = threading.Barrier(devices)
+    errors = []
+
+    def open_recipe(client):
+        barrier.wait()
+        try:
+            client.send(event)
+        except Exception as e:
+            errors.append(e)
+
+    before = drive.request_count
+    threads = [threading.Thread(target=open_recipe, args=(client,)) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for client in clients:
+        client.close()
+    return drive.request_count - before, errors
+
+
+def run_sustained(port, api_endpoint, devices, duration, device_ids=('bench-device',), seed=None):
+    """
+    Loop navigation sessions on every device, cycling through device_ids.
+    With a seed, each device opens random recipes. Returns ({device id:
+    latencies in ms}, errors, elapsed seconds).
+    """
+    latencies = {device_id: [] for device_id in device_ids}
+    errors = []
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def device_loop(number):
+        client = Device(port)
+        device_id = device_ids[number % len(device_ids)]
+        rng = random.Random(seed + number) if seed is not None else None
+        local = []
+        try:
+            while time.monotonic() < stop_at:
+                session = bench.navigation_session(rng)
+                session_attributes = {}
+                try:
+                    step, request = next(session)
+                    while True:
+                        started = time.perf_counter()
+                        response = client.send(bench.make_event(request, session_attributes, api_endpoint, device_id))
+                        local.append((time.perf_counter() - started) * 1000)
+                        session_attributes = response.get('sessionAttributes', session_attributes)
+                        step, request = session.send(response)
+                except StopIteration:
+                    pass
+        except Exception as e:
+            with lock:
+                errors.append(e)
+        finally:
+            client.close()
+            with lock:
+                latencies[device_id].extend(local)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=device_loop, args=(number,)) for number in range(devices)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors, time.perf_counter() - started
+
+
+def print_tenant_report(households, latencies):
+    """Print each household's latency, hit ratios and cache use, then the container totals."""
+    lf = lambda_function
+    print(f"  {'household':<14}{'reqs':>7}{'p95 ms':>9}{'listing hit':>13}{'content hit':>13}"
+          f"{'listings':>10}{'content KiB':>13}")
+    for tenant_id, (_, device_id) in households.items():
+        listing = lf.listing_cache.stats(tenant_id)
+        content = lf.content_cache.stats(tenant_id)
+        samples = latencies[device_id]
+        p95 = bench.percentile(samples, 0.95) if samples else 0.0
+        print(f"  {tenant_id:<14}{len(samples):>7}{p95:>9.2f}{listing['hit_ratio']:>13.3f}{content['hit_ratio']:>13.3f}"
+              f"{listing['entries']:>10}{content['memory_bytes'] / 1024:>13.1f}")
+    print(f'  quotas per household: {lf.TENANT_LISTING_MAX_ENTRIES} listings, '
+          f'{lf.TENANT_CONTENT_MEMORY_MAX_BYTES / 1024:.0f} KiB of content')
+    print(f'  container: {lf.listing_cache.stats()["entries"]}/{lf.LISTING_CACHE_MAX_ENTRIES} listings, '
+          f'{lf.content_cache.stats()["memory_bytes"] / 1024:.1f}/{lf.CONTENT_MEMORY_MAX_BYTES / 1024:.0f} KiB of content')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=20, help='Concurrent devices')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds of sustained load')
+    parser.add_argument('--recipes', type=int, default=1000, help='Recipes in the synthetic tree (per household with --tenants)')
+    parser.add_argument('--latency-ms', type=float, default=20, help='Latency added to every fake API response')
+    parser.add_argument('--workers', type=int, default=serve.DEFAULT_WORKERS, help='Server thread pool size')
+    parser.add_argument('--tenants', type=int, default=0, help='Simulate this many households')
+    parser.add_argument('--huge-recipes', type=int, default=10000, help='Recipes in the first household\'s tree')
+    parser.add_argument('--tenant-listing-entries', type=int, default=64, help='Listing cache quota per household')
+    parser.add_argument('--tenant-content-kb', type=int, default=64, help='Content memory quota per household')
+    parser.add_argument('--trace-memory', action='store_true', help='Report peak Python memory, fake Drive included (slows the run)')
+    args = parser.parse_args()
+
+    lambda_function.logger.setLevel('WARNING')
+    lambda_function.METRICS_ENABLED = False
+    lambda_function.PREFETCH_ENABLED = False
+
+    work_dir = f'/tmp/recipe-loadtest-{time.time_ns()}'
+    households = {}
+    if args.tenants:
+        drive = fake_drive.FakeDrive(latency=args.latency_ms / 1000)
+        households = setup_tenants(drive, args.tenants, args.recipes, args.huge_recipes, work_dir)
+        # Small enough that the huge library overflows its quota during the run
+        lf = lambda_function
+        lf.TENANT_LISTING_MAX_ENTRIES = args.tenant_listing_entries
+        lf.LISTING_CACHE_MAX_ENTRIES = args.tenant_listing_entries * args.tenants // 2
+        lf.TENANT_CONTENT_MEMORY_MAX_BYTES = args.tenant_content_kb * 1024
+        lf.CONTENT_MEMORY_MAX_BYTES = args.tenant_content_kb * 1024 * args.tenants // 2
+    else:
+        drive = fake_drive.FakeDrive(fake_drive.synthetic_tree(args.recipes), latency=args.latency_ms / 1000)
+    drive_server = fake_drive.serve(drive)
+    api_endpoint = f'http://127.0.0.1:{drive_server.server_port}'
+    lambda_function.DRIVE_API_BASE = api_endpoint
+    lambda_function.API_KEY = 'loadtest-key'
+    lambda_function.ROOT_FOLDER_ID = 'root'
+    bench.reset_skill_state(work_dir)
+    port = serve.serve_in_background(workers=args.workers)
+    if args.trace_memory:
+        tracemalloc.start()
+
+    prefix, device_id = next(iter(households.values()), ('', 'bench-device'))
+    drive_requests, errors = run_burst(port, drive, api_endpoint, args.devices, prefix, device_id)
+    print(f'burst: {args.devices} devices opened the same recipe with {drive_requests} Drive requests'
+          f'{f", {len(errors)} errors" if errors else ""}')
+
+    before = drive.request_count
+    device_ids = [device_id for _, device_id in households.values()] or ['bench-device']
+    by_device, errors, elapsed = run_sustained(
+        port, api_endpoint, args.devices, args.duration, device_ids, seed=0 if households else None
+    )
+    latencies = [ms for samples in by_device.values() for ms in samples]
+    print(f'sustained: {len(latencies)} requests from {args.devices} devices in {elapsed:.1f} s '
+          f'= {len(latencies) / elapsed:.0f} requests/s')
+    if latencies:
+        print(f'  latency p50 {bench.percentile(latencies, 0.50):.2f} ms, '
+              f'p95 {bench.percentile(latencies, 0.95):.2f} ms, p99 {bench.percentile(latencies, 0.99):.2f} ms')
+    print(f'  {drive.request_count - before} Drive/Timer requests, '
+          f'{lambda_function.listing_cache.stats()["coalesced"] + lambda_function.export_flights.coalesced} '
+          f'fetches coalesced, {len(errors)} errors')
+    for error in errors[:5]:
+        print(f'  error: {error}')
+    if households:
+        print_tenant_report(households, by_device)
+    if args.trace_memory:
+        print(f'  peak Python memory {tracemalloc.get_traced_memory()[1] / 1024 / 1024:.1f} MiB')
+        tracemalloc.stop()
+
+
+if __name__ == '__main__':
+    main()
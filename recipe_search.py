@@ -0,0 +1,363 @@
+import heapq
+import logging
+import marshal
+import math
+import os
+import re
+import sys
+import threading
+import zlib
+from collections import Counter
+
+logger = logging.getLogger()
+
+# Bumped whenever the on-disk layout or tokenizer changes so old files are ignored.
+# The file is marshal data, so the Python version is part of the format too.
+INDEX_FORMAT_VERSION = (2, sys.version_info[:2])
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Title words count this many times as often as words in the body
+TITLE_WEIGHT = 3
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+STOPWORDS = frozenset(
+    'a an and any are for from how i in is me my of on or show some the to what with '
+    'recipe recipes find'.split()
+)
+
+
+def tokenize(text):
+    """Lowercase text, split it into words and fold simple plurals."""
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        if len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+class SearchIndex:
+    """
+    Inverted index over cleaned recipe text with BM25 ranking.
+    Documents are keyed by Drive file id and only re-indexed when their
+    modifiedTime changes.
+    """
+
+    def __init__(self):
+        self.docs = {}  # file_id -> {'name', 'modifiedTime', 'length', 'terms'}
+        self.postings = {}  # term -> {file_id: term frequency}
+        self.total_length = 0
+        self.dirty = False
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.docs)
+
+    def has_version(self, file_id, modified_time):
+        doc = self.docs.get(file_id)
+        return doc is not None and doc['modifiedTime'] == modified_time
+
+    def update(self, file_id, name, modified_time, text):
+        """Index a document, replacing any older version of it."""
+        if self.has_version(file_id, modified_time):
+            return False
+        counts = Counter(tokenize(text))
+        for token in tokenize(name or ''):
+            counts[token] += TITLE_WEIGHT
+        with self._lock:
+            self._remove(file_id)
+            for term, tf in counts.items():
+                self.postings.setdefault(term, {})[file_id] = tf
+            length = sum(counts.values())
+            self.docs[file_id] = {'name': name, 'modifiedTime': modified_time, 'length': length, 'terms': tuple(counts)}
+            self.total_length += length
+            self.dirty = True
+        return True
+
+    def remove(self, file_id):
+        with self._lock:
+            self._remove(file_id)
+
+    def retain(self, file_ids):
+        """Remove every document not in file_ids; returns how many were removed."""
+        with self._lock:
+            gone = [file_id for file_id in self.docs if file_id not in file_ids]
+            for file_id in gone:
+                self._remove(file_id)
+        return len(gone)
+
+    def _remove(self, file_id):
+        doc = self.docs.pop(file_id, None)
+        if doc is None:
+            return
+        self.total_length -= doc['length']
+        # Only the document's own terms have postings for it
+        for term in doc['terms']:
+            postings = self.postings.get(term)
+            if postings is not None and postings.pop(file_id, None) is not None and not postings:
+                del self.postings[term]
+        self.dirty = True
+
+    def search(self, query, limit=10):
+        """Return up to limit [{'id', 'name', 'score'}] results, best first."""
+        terms = set(tokenize(query))
+        if not terms or not self.docs:
+            return []
+        with self._lock:
+            doc_count = len(self.docs)
+            avg_length = self.total_length / doc_count
+            scores = Counter()
+            for term in terms:
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for file_id, tf in postings.items():
+                    length_norm = 1 - BM25_B + BM25_B * self.docs[file_id]['length'] / avg_length
+                    scores[file_id] += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * length_norm)
+            return [
+                {'id': file_id, 'name': self.docs[file_id]['name'], 'score': score}
+                for file_id, score in scores.most_common(limit)
+            ]
+
+    def save(self, path):
+        """
+        Write the index as zlib-compressed marshal data, which loads several
+        times faster than JSON on a cold start.
+        """
+        with self._lock:
+            data = marshal.dumps((INDEX_FORMAT_VERSION, self.docs, self.postings))
+            self.dirty = False
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(zlib.compress(data, 1))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load an index written by save(), or return an empty one."""
+        index = cls()
+        try:
+            with open(path, 'rb') as f:
+                version, docs, postings = marshal.loads(zlib.decompress(f.read()))
+        except FileNotFoundError:
+            return index
+        except Exception as e:
+            logger.error(f"Error loading search index from {path}: {e}")
+            return index
+        if version != INDEX_FORMAT_VERSION:
+            return index
+
+        index.docs = docs
+        index.postings = postings
+        index.total_length = sum(doc['length'] for doc in docs.values())
+        return index
+
+
+# === Spoken titles ===
+
+# Words people say around a recipe title ("open the recipe for ...")
+TITLE_FILLER = frozenset('open pull up please'.split())
+
+SOUNDEX_CODES = {
+    char: digit
+    for digit, chars in {'1': 'bfpv', '2': 'cgjkqsxz', '3': 'dt', '4': 'l', '5': 'mn', '6': 'r'}.items()
+    for char in chars
+}
+
+# How many candidates from the token postings are scored in full
+TITLE_SHORTLIST = 50
+TITLE_TOKEN_WEIGHT = 0.6
+# A word that only sounds like a title word counts this much of an exact match
+PHONETIC_MATCH_WEIGHT = 0.7
+
+
+def title_tokens(text):
+    # "Grandma's" is heard as "grandmas"
+    text = text.replace("'", '').replace('\u2019', '')
+    return [token for token in tokenize(text) if token not in TITLE_FILLER]
+
+
+def soundex(token):
+    """American Soundex code of a word ('cookie' -> 'C200'); numbers are returned as is."""
+    if not token[0].isalpha():
+        return token
+    code = [token[0].upper()]
+    last = SOUNDEX_CODES.get(token[0], '')
+    for char in token[1:]:
+        digit = SOUNDEX_CODES.get(char, '')
+        if digit and digit != last:
+            code.append(digit)
+        if char not in 'hw':
+            last = digit
+    return ''.join(code).ljust(4, '0')[:4]
+
+
+def trigrams(tokens):
+    text = f" {' '.join(tokens)} "
+    return frozenset(text[i:i + 3] for i in range(len(text) - 2))
+
+
+class TitleIndex:
+    """
+    Resolves a spoken recipe title to Drive file ids. Each title is indexed
+    by its normalized words, their Soundex codes and the character trigrams
+    of the whole title. It is kept up to date per folder from the listings
+    the skill already fetches.
+    """
+
+    def __init__(self):
+        self.titles = {}  # file_id -> {'name', 'folder', 'tokens', 'keys', 'grams'}
+        self.folders = {}  # folder_id -> {file_id: name} as last indexed
+        self.token_postings = {}
+        self.phonetic_postings = {}
+        self.trigram_postings = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.titles)
+
+    def file_ids(self):
+        with self._lock:
+            return list(self.titles)
+
+    def update_folder(self, folder_id, recipes):
+        """
+        Index a folder's [{'id', 'name'}] listing, touching only what changed.
+        Returns the ids of titles that dropped out of the index, i.e. that
+        left this folder and weren't seen in another one since.
+        """
+        listing = {recipe['id']: recipe['name'] for recipe in recipes}
+        removed = []
+        with self._lock:
+            previous = self.folders.get(folder_id, {})
+            if previous == listing:
+                return removed
+            for file_id in previous.keys() - listing.keys():
+                if self.titles.get(file_id, {}).get('folder') == folder_id:
+                    self._remove(file_id)
+                    removed.append(file_id)
+            for file_id, name in listing.items():
+                if previous.get(file_id) != name:
+                    self._remove(file_id)
+                    self._add(file_id, name, folder_id)
+            self.folders[folder_id] = listing
+        return removed
+
+    def _add(self, file_id, name, folder_id):
+        tokens = title_tokens(name)
+        entry = {
+            'name': name,
+            'folder': folder_id,
+            'tokens': frozenset(tokens),
+            'keys': frozenset(soundex(token) for token in tokens),
+            'grams': trigrams(tokens)
+        }
+        self.titles[file_id] = entry
+        for postings, terms in (
+            (self.token_postings, entry['tokens']),
+            (self.phonetic_postings, entry['keys']),
+            (self.trigram_postings, entry['grams'])
+        ):
+            for term in terms:
+                postings.setdefault(term, set()).add(file_id)
+
+    def _remove(self, file_id):
+        entry = self.titles.pop(file_id, None)
+        if entry is None:
+            return
+        for postings, terms in (
+            (self.token_postings, entry['tokens']),
+            (self.phonetic_postings, entry['keys']),
+            (self.trigram_postings, entry['grams'])
+        ):
+            for term in terms:
+                ids = postings.get(term)
+                if ids is not None:
+                    ids.discard(file_id)
+                    if not ids:
+                        del postings[term]
+
+    def _join_compounds(self, tokens):
+        """Merge spoken word pairs that are one word in a title ("butter milk" -> "buttermilk")."""
+        joined = []
+        for token in tokens:
+            if joined and joined[-1] + token in self.token_postings:
+                joined[-1] += token
+            else:
+                joined.append(token)
+        return joined
+
+    def _shortlist(self, word_postings, grams):
+        """
+        Pick the titles worth scoring in full. When some titles contain every
+        spoken word, those with the fewest other words are taken (set
+        intersections stay fast on large collections). Otherwise titles are
+        ranked by the spoken words they share, rare words weighing more,
+        and by shared trigrams when no word matches at all.
+        """
+        if all(word_postings):
+            common = set.intersection(*sorted(word_postings, key=len))
+            if common:
+                return heapq.nsmallest(TITLE_SHORTLIST, common, key=lambda file_id: len(self.titles[file_id]['tokens']))
+
+        candidates = Counter()
+        for postings in word_postings:
+            if postings:
+                weight = math.log(1 + len(self.titles) / len(postings))
+                for file_id in postings:
+                    candidates[file_id] += weight
+        if not candidates:
+            for gram in grams:
+                candidates.update(self.trigram_postings.get(gram, ()))
+        return [file_id for file_id, _ in candidates.most_common(TITLE_SHORTLIST)]
+
+    def match(self, spoken, limit=5):
+        """
+        Return up to limit [{'id', 'name', 'score', 'complete', 'exact'}] titles
+        for a spoken title, best first. complete is set when the title has every
+        spoken word (or a sound-alike of a word no title has), and exact when it
+        has no other words either.
+        """
+        with self._lock:
+            tokens = self._join_compounds(title_tokens(spoken))
+            if not tokens or not self.titles:
+                return []
+            keys = [soundex(token) for token in tokens]
+            grams = trigrams(tokens)
+
+            # A word that isn't in any title counts through its sound-alikes
+            word_postings = []
+            for token, key in zip(tokens, keys):
+                postings = self.token_postings.get(token)
+                if postings is None:
+                    postings = self.phonetic_postings.get(key, set())
+                word_postings.append(postings)
+            shortlist = self._shortlist(word_postings, grams)
+
+            results = []
+            for file_id in shortlist:
+                entry = self.titles[file_id]
+                matched = sum(
+                    1 if token in entry['tokens'] else PHONETIC_MATCH_WEIGHT if key in entry['keys'] else 0
+                    for token, key in zip(tokens, keys)
+                )
+                token_score = 2 * matched / (len(tokens) + len(entry['tokens']))
+                gram_score = 2 * len(grams & entry['grams']) / (len(grams) + len(entry['grams']))
+                score = TITLE_TOKEN_WEIGHT * token_score + (1 - TITLE_TOKEN_WEIGHT) * gram_score
+                complete = all(file_id in postings for postings in word_postings)
+                results.append({
+                    'id': file_id,
+                    'name': entry['name'],
+                    'score': score,
+                    'complete': complete,
+                    'exact': complete and len(entry['tokens']) == len(set(tokens))
+                })
+        results.sort(key=lambda result: -result['score'])
+        return results[:limit]
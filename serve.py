@@ -0,0 +1,306 @@
+"""
+Run the skill as a self-hosted HTTPS endpoint instead of a Lambda function,
+for households or shops with several Echo Shows.
+
+    python serve.py --port 8080 --skill-id amzn1.ask.skill... --api-key KEY --root FOLDER_ID
+    DRIVE_API_BASE=http://127.0.0.1:8081 python serve.py --insecure   # against fake_drive.py
+
+Alexa POSTs each request as JSON and gets lambda_handler's response back.
+Connections are handled by an asyncio event loop and requests run on a
+bounded thread pool, so every device shares one set of caches and one Drive
+connection pool, and devices opening the same category or recipe at once
+share a single Drive fetch. Alexa only calls HTTPS endpoints, so put this
+behind a TLS-terminating proxy.
+
+Every request is checked here, since a proxy can't: it must carry a valid
+Alexa signature (Signature-256 and SignatureCertChainUrl headers), a
+timestamp within 150 seconds, and one of the --skill-id values. Checking
+signatures needs the cryptography package (42 or newer). --insecure turns
+all checks off for local testing; anyone who can reach the port can then
+act as any household.
+"""
+import argparse
+import asyncio
+import base64
+import datetime
+import json
+import logging
+import posixpath
+import ssl
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import lambda_function
+
+logger = logging.getLogger()
+
+# Alexa gives up on a skill response after 8 seconds
+ALEXA_TIMEOUT_SECONDS = 8
+MAX_BODY_BYTES = 256 * 1024
+DEFAULT_WORKERS = 16
+
+# Where Alexa's signing certificates may come from, and the name they're issued to
+ALEXA_CERT_HOST = 's3.amazonaws.com'
+ALEXA_CERT_PATH_PREFIX = '/echo.api/'
+ALEXA_CERT_SUBJECT = 'echo-api.amazon.com'
+ALEXA_MAX_CLOCK_SKEW_SECONDS = 150
+
+
+class InvocationContext:
+    """The parts of the Lambda context object the skill uses."""
+
+    def __init__(self, timeout=ALEXA_TIMEOUT_SECONDS):
+        self._deadline = time.monotonic() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self._deadline - time.monotonic()) * 1000))
+
+
+def invoke(event):
+    try:
+        return 200, lambda_function.lambda_handler(event, InvocationContext())
+    except Exception as e:
+        logger.error(f"Unhandled error in lambda_handler: {e}")
+        return 500, {'message': 'Internal error'}
+
+
+class RequestRejected(Exception):
+    """Raised for a request that didn't come from Alexa for this skill."""
+
+
+def check_cert_url(url):
+    """Check a SignatureCertChainUrl against the locations Alexa uses."""
+    parts = urllib.parse.urlsplit(url)
+    if (parts.scheme.lower() != 'https' or (parts.hostname or '').lower() != ALEXA_CERT_HOST
+            or parts.port not in (None, 443)
+            or not posixpath.normpath(parts.path).startswith(ALEXA_CERT_PATH_PREFIX)):
+        raise RequestRejected(f'Untrusted certificate URL {url}')
+
+
+class RequestVerifier:
+    """Checks that requests are signed by Alexa, recent, and for one of skill_ids."""
+
+    def __init__(self, skill_ids, ca_file=None):
+        from cryptography import x509
+        from cryptography.x509.verification import Store
+
+        self.skill_ids = set(skill_ids)
+        with open(ca_file or ssl.get_default_verify_paths().cafile, 'rb') as f:
+            self._store = Store(x509.load_pem_x509_certificates(f.read()))
+        self._certificates = {}  # url -> (certificate, not valid after)
+        self._lock = threading.Lock()
+
+    def verify(self, headers, body, event):
+        """Raise RequestRejected unless the request is genuine."""
+        self._check_signature(headers, body)
+        request = event.get('request', {})
+        try:
+            timestamp = datetime.datetime.fromisoformat(request['timestamp'].replace('Z', '+00:00'))
+        except (KeyError, AttributeError, ValueError):
+            raise RequestRejected('Request has no valid timestamp')
+        skew = abs((datetime.datetime.now(datetime.timezone.utc) - timestamp).total_seconds())
+        if skew > ALEXA_MAX_CLOCK_SKEW_SECONDS:
+            raise RequestRejected(f'Request timestamp is {skew:.0f} seconds off')
+        application_id = event.get('context', {}).get('System', {}).get('application', {}).get('applicationId')
+        if application_id not in self.skill_ids:
+            raise RequestRejected(f'Request is for another skill: {application_id}')
+
+    def _check_signature(self, headers, body):
+        from cryptography.exceptions import InvalidSignature
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import padding
+
+        url = headers.get('signaturecertchainurl')
+        signature = headers.get('signature-256')
+        if not url or not signature:
+            raise RequestRejected('Request is not signed')
+        try:
+            self._certificate(url).public_key().verify(
+                base64.b64decode(signature), body, padding.PKCS1v15(), hashes.SHA256()
+            )
+        except (InvalidSignature, ValueError):
+            raise RequestRejected('Request signature does not match')
+
+    def _certificate(self, url):
+        """Return the signing certificate at url, fetched and verified once while it is valid."""
+        from cryptography import x509
+        from cryptography.x509.verification import PolicyBuilder
+
+        check_cert_url(url)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self._lock:
+            cached = self._certificates.get(url)
+        if cached and now < cached[1]:
+            return cached[0]
+        try:
+            _, pem = lambda_function.http_request(url)
+            chain = x509.load_pem_x509_certificates(pem)
+            verifier = PolicyBuilder().store(self._store).time(now).build_server_verifier(x509.DNSName(ALEXA_CERT_SUBJECT))
+            verifier.verify(chain[0], chain[1:])
+        except Exception as e:
+            raise RequestRejected(f'Signing certificate at {url} is not valid: {e}')
+        with self._lock:
+            self._certificates[url] = (chain[0], chain[0].not_valid_after_utc)
+        return chain[0]
+
+
+def handle_request(headers, body, verifier=None):
+    """Parse, check and run one POSTed Alexa request; returns (status, payload)."""
+    try:
+        event = json.loads(body)
+    except ValueError:
+        return 400, {'message': 'Body is not JSON'}
+    if verifier is not None:
+        try:
+            verifier.verify(headers, body, event)
+        except RequestRejected as e:
+            logger.warning(f"Rejected request: {e}")
+            return 400, {'message': 'Request could not be verified'}
+    return invoke(event)
+
+
+async def read_request(reader):
+    """Read one HTTP/1.1 request; returns (method, path, headers, body) or None at EOF."""
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length > MAX_BODY_BYTES:
+        raise ValueError(f'Request body of {length} bytes is too large')
+    body = await reader.readexactly(length) if length else b''
+    return method, path, headers, body
+
+
+def write_response(writer, status, payload, keep_alive):
+    body = json.dumps(payload).encode('utf-8')
+    reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}.get(status, 'Error')
+    writer.write(
+        f'HTTP/1.1 {status} {reason}\r\n'
+        f'Content-Type: application/json;charset=UTF-8\r\n'
+        f'Content-Length: {len(body)}\r\n'
+        f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode('latin-1') + body
+    )
+
+
+class SkillServer:
+    def __init__(self, workers=DEFAULT_WORKERS, verifier=None):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='skill')
+        self.verifier = verifier
+        self.requests_served = 0
+
+    async def handle_connection(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except (ValueError, asyncio.IncompleteReadError) as e:
+                    write_response(writer, 400, {'message': str(e)}, False)
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+
+                if method == 'GET' and path == '/health':
+                    write_response(writer, 200, {'status': 'ok', 'served': self.requests_served}, keep_alive)
+                elif method != 'POST':
+                    write_response(writer, 405, {'message': 'POST an Alexa request'}, keep_alive)
+                else:
+                    # Checking a signature may fetch a certificate, so it runs on the pool too
+                    status, payload = await loop.run_in_executor(self.executor, handle_request, headers, body, self.verifier)
+                    self.requests_served += 1
+                    write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host, port):
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+
+def serve_in_background(host='127.0.0.1', port=0, workers=DEFAULT_WORKERS, verifier=None):
+    """
+    Run the endpoint on a background thread and return the port it listens on.
+    Requests are only checked when a verifier is given.
+    """
+    started = threading.Event()
+    bound = {}
+
+    def run():
+        loop = asyncio.new_event_loop()
+        server = loop.run_until_complete(SkillServer(workers, verifier).start(host, port))
+        bound['port'] = server.sockets[0].getsockname()[1]
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+    return bound['port']
+
+
+async def main_async(args, verifier):
+    server = await SkillServer(args.workers, verifier).start(args.host, args.port)
+    print(f'Skill endpoint listening on http://{args.host}:{args.port}')
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Requests handled at the same time')
+    parser.add_argument('--api-key', help='Google Drive API key (defaults to the one in lambda_function.py)')
+    parser.add_argument('--root', help='Root recipe folder id (defaults to the one in lambda_function.py)')
+    parser.add_argument('--tenants', help='JSON file of households and their root folders (see TENANTS_FILE)')
+    parser.add_argument('--metrics', action='store_true', help='Print a metrics line per request')
+    parser.add_argument('--skill-id', action='append', default=[], help='Alexa skill id to accept requests for (repeatable)')
+    parser.add_argument('--ca-file', help='Trusted root certificates for Alexa signatures (defaults to the system store)')
+    parser.add_argument('--insecure', action='store_true', help='Accept unsigned requests for any skill (local testing only)')
+    args = parser.parse_args()
+
+    verifier = None
+    if not args.insecure:
+        if not args.skill_id:
+            parser.error('--skill-id is required (or --insecure for local testing)')
+        try:
+            verifier = RequestVerifier(args.skill_id, args.ca_file)
+        except ImportError:
+            parser.error('checking Alexa signatures needs the cryptography package: pip install "cryptography>=42"')
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    if args.api_key:
+        lambda_function.API_KEY = args.api_key
+    if args.root:
+        lambda_function.ROOT_FOLDER_ID = args.root
+    if args.tenants:
+        lambda_function.TENANTS_FILE = args.tenants
+    # Importing lambda_function ran init() before these overrides, so the
+    # snapshot it looked for belonged to the default root; set up again
+    lambda_function._snapshots.clear()
+    lambda_function._tenant_registry = None
+    lambda_function.init()
+    lambda_function.METRICS_ENABLED = args.metrics
+    try:
+        asyncio.run(main_async(args, verifier))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()